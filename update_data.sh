@@ -1,3 +1,3 @@
 #!/usr/bin/env bash
 
-docker-compose exec web bash -c "python manage.py update_data" 
\ No newline at end of file
+docker-compose exec web bash -c "python manage.py update_data --staged" 
\ No newline at end of file
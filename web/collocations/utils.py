@@ -1,12 +1,28 @@
+"""
+Collocations over the token-id corpus of ``kwic.index``.
+
+For each n-gram size and window size, the counts NLTK's collocation finders collect in from_words() are
+computed once with NumPy and persisted as memory-mapped arrays, together with an index from each word to
+the n-grams containing it. Association measures are then only computed for the n-grams a request can
+show, i.e. those containing the query word.
+"""
+from collections import Counter
+from dataclasses import dataclass
+import hashlib
+from itertools import combinations
 import logging
 import nltk
 from nltk import collocations
+import numpy as np
+import os
+from pathlib import Path
+import pickle
+import shutil
+import tempfile
 
-from typing import List, Tuple
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
 
-from freqdist.models import TextFile
-from kwic.utils import _clean_texts, _get_texts
-from core.models import Example
+from kwic import index as corpus_index
 
 
 logger = logging.getLogger(__name__)
@@ -27,6 +43,295 @@ MEASURES_FINDERS_DICT = {
     ]
 }
 
+NGRAM_SIZES = {'bigram': 2, 'trigram': 3, 'quadgram': 4}
+SPAN_TOKENS = 1 << 22  # texts are counted in groups of about this many tokens, which bounds memory use
+
+COUNTS_DIR = Path(__file__).parent / 'static/collocations/ngrams'
+if not COUNTS_DIR.exists():
+    COUNTS_DIR.mkdir(parents=True)
+
+# The counts each finder is built from besides word_fd, in constructor order, as positions in the window.
+FINDER_TABLES = {
+    2: [(0, 1)],  # bigram_fd
+    3: [(0, 1), (0, 2), (0, 1, 2)],  # bigram_fd, wildcard_fd, trigram_fd
+    4: [(0, 1, 2, 3), (0, 1), (0, 1, 2), (0, 2), (0, 3), (0, 1, 3), (0, 2, 3)],  # iiii, ii, iii, ixi, ixxi, iixi, ixii
+}
+NGRAM_TABLE = {2: 0, 3: 2, 4: 0}  # index of the n-gram counts themselves in FINDER_TABLES
+
+# The marginal counts score_ngram() passes to the association measure after the n-gram count, in groups.
+# Each is (index in FINDER_TABLES or None for word_fd, positions in the scored n-gram).
+SCORE_MARGINALS = {
+    2: [
+        [(None, (0,)), (None, (1,))],
+    ],
+    3: [
+        [(0, (0, 1)), (1, (0, 2)), (0, (1, 2))],
+        [(None, (0,)), (None, (1,)), (None, (2,))],
+    ],
+    4: [
+        [(2, (0, 1, 2)), (5, (0, 1, 3)), (6, (0, 2, 3)), (2, (1, 2, 3))],
+        [(1, (0, 1)), (3, (0, 2)), (4, (0, 3)), (3, (1, 3)), (1, (2, 3)), (1, (1, 2))],
+        [(None, (0,)), (None, (1,)), (None, (2,)), (None, (3,))],
+    ],
+}
+
+# Counts are immutable once written, so loaded ones are kept per worker by directory name.
+_COUNTS_CACHE = {}
+
+
+@dataclass
+class NgramCounts:
+    """
+    Everything from_words() counts for one n-gram size and window size. Tables are sorted by key.
+    :param radix: Base of the row keys (see ``_row_keys()``), i.e. the vocabulary size when counted
+    :param total: Number of words counted, the N of the association measures
+    :param word_counts: Count of each word id
+    :param keys: Row keys of each table in FINDER_TABLES order
+    :param counts: Counts matching ``keys``
+    :param ngrams: The n-grams as rows of ids, in the order of their table
+    :param postings: Indexes of the n-grams containing each word, grouped by word id
+    :param postings_start: Where the n-grams of word id i start in ``postings``
+    """
+    n: int
+    window_size: int
+    radix: int
+    total: int
+    word_counts: np.ndarray
+    keys: List[np.ndarray]
+    counts: List[np.ndarray]
+    ngrams: np.ndarray
+    postings: np.ndarray
+    postings_start: np.ndarray
+
+    @property
+    def ngram_counts(self) -> np.ndarray:
+        return self.counts[NGRAM_TABLE[self.n]]
+
+    def containing(self, word_ids: Sequence[int]) -> np.ndarray:
+        """Indexes of the n-grams containing any of the words."""
+        parts = [self.postings[self.postings_start[i]:self.postings_start[i + 1]] for i in word_ids
+                 if i < self.radix]
+        return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+
+def _row_keys(columns: Sequence[np.ndarray], radix: int) -> np.ndarray:
+    """One sortable key per row of the id columns: a single int64 if it fits, raw bytes otherwise."""
+    if radix ** len(columns) < 2 ** 63:
+        keys = np.zeros(len(columns[0]), dtype=np.int64)
+        for column in columns:
+            keys = keys * radix + column
+        return keys
+    rows = np.ascontiguousarray(np.stack(columns, axis=1).astype(corpus_index.ID_DTYPE))
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+
+def _spans(texts: Sequence[np.ndarray], lookahead: int) -> Iterator[Tuple[np.ndarray, int]]:
+    """
+    Yield consecutive texts joined in groups of about ``SPAN_TOKENS``, followed by the first ``lookahead``
+    tokens after the group, and the length of the group itself. Windows starting near the end of a group
+    thus run on into the next texts, as if all of them were joined.
+    """
+    k = 0
+    while k < len(texts):
+        parts, size = [], 0
+        while k < len(texts) and (not parts or size + len(texts[k]) <= SPAN_TOKENS):
+            parts.append(texts[k])
+            size += len(texts[k])
+            k += 1
+        missing = lookahead
+        for following in range(k, len(texts)):
+            if missing <= 0:
+                break
+            parts.append(texts[following][:missing])
+            missing -= len(parts[-1])
+        yield (np.concatenate(parts) if len(parts) > 1 else parts[0]), size
+
+
+def _merge_counts(keys: np.ndarray, rows: np.ndarray, weights: np.ndarray) -> Tuple[np.ndarray, np.ndarray,
+                                                                                   np.ndarray]:
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=weights).astype(np.int64)
+    return keys[first], rows[first], counts
+
+
+def _count_in_windows(texts: Sequence[np.ndarray], positions: Tuple[int, ...], n: int, window_size: int,
+                      radix: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Count the words at ``positions`` of every combination of n - 1 words following each word within
+    ``window_size``, as from_words() does. Windows running past the end of the corpus are padded there,
+    and tuples reaching into the padding are skipped. Texts are counted a group at a time, so the corpus
+    is never copied into memory as a whole.
+    :return: The sorted keys of the distinct tuples, the tuples as rows of ids, and their counts
+    """
+    # Different combinations can put the counted positions at the same offsets; count those once, weighted.
+    weights = Counter()
+    for combination in combinations(range(1, window_size), n - 1):
+        window = (0,) + combination
+        weights[tuple(window[p] for p in positions)] += 1
+
+    partial = []
+    for span, starts in _spans(texts, window_size - 1):
+        columns = [[] for _ in positions]
+        segment_weights = []
+        for offsets, weight in weights.items():
+            length = min(len(span) - offsets[-1], starts)
+            if length <= 0:
+                continue
+            for column, offset in zip(columns, offsets):
+                column.append(span[offset:offset + length])
+            segment_weights.append(np.full(length, weight, dtype=np.int64))
+        if not segment_weights:
+            continue
+        columns = [np.concatenate(column) for column in columns]
+        partial.append(_merge_counts(_row_keys(columns, radix), np.stack(columns, axis=1),
+                                     np.concatenate(segment_weights)))
+
+    if not partial:
+        return (_row_keys([np.empty(0, dtype=corpus_index.ID_DTYPE)] * len(positions), radix),
+                np.empty((0, len(positions)), dtype=corpus_index.ID_DTYPE), np.empty(0, dtype=np.int64))
+    if len(partial) == 1:
+        return partial[0]
+    return _merge_counts(*(np.concatenate(parts) for parts in zip(*partial)))
+
+
+def count_ngrams(texts: Sequence[np.ndarray], n: int, window_size: int, radix: int) -> NgramCounts:
+    """
+    Count what ``from_words(tokens, window_size)`` would, with NumPy over token ids.
+    :param texts: Token ids of each text of the corpus, counted as if the texts were joined
+    :param radix: Number of word ids
+    """
+    if window_size < n:
+        raise ValueError(f"Specify window_size at least {n}")
+    word_counts = np.zeros(radix, dtype=np.int64)
+    for ids in texts:
+        word_counts += np.bincount(ids, minlength=radix)
+    if n > 2:  # counted once per combination of the following words rather than once per window
+        word_counts *= len(list(combinations(range(1, window_size), n - 1)))
+
+    keys, counts = [], []
+    for i, positions in enumerate(FINDER_TABLES[n]):
+        table_keys, rows, table_counts = _count_in_windows(texts, positions, n, window_size, radix)
+        keys.append(table_keys)
+        counts.append(table_counts)
+        if i == NGRAM_TABLE[n]:
+            ngrams = rows
+
+    # Pairs of (word, n-gram), sorted by word, give the n-grams of each word as one slice.
+    size = max(len(ngrams), 1)
+    pairs = np.unique(ngrams.astype(np.int64) * size + np.arange(len(ngrams))[:, None])
+    postings = pairs % size
+    postings_start = np.searchsorted(pairs // size, np.arange(radix + 1))
+    return NgramCounts(n=n, window_size=window_size, radix=radix, total=int(word_counts.sum()),
+                       word_counts=word_counts, keys=keys, counts=counts, ngrams=ngrams, postings=postings,
+                       postings_start=postings_start)
+
+
+def _counts_dir(n: int, window_size: int, include_examples: bool, docs: List[corpus_index.IndexedDoc]) -> Path:
+    """Directory of the counts for this corpus. Its name changes whenever a text is added or removed."""
+    signature = repr([(doc.name, len(doc.ids), doc.signature) for doc in docs])
+    digest = hashlib.sha1(signature.encode()).hexdigest()[:16]
+    return COUNTS_DIR / f'{n}_{window_size}_{int(include_examples)}_{digest}'
+
+
+def _write_ngram_counts(path: Path, counts: NgramCounts) -> None:
+    """Write into a fresh directory and rename it, so that other workers never read partial counts."""
+    tmp = Path(tempfile.mkdtemp(dir=COUNTS_DIR, suffix='.tmp'))
+    arrays = {'word_counts': counts.word_counts, 'ngrams': counts.ngrams, 'postings': counts.postings,
+              'postings_start': counts.postings_start}
+    for i, (keys, table_counts) in enumerate(zip(counts.keys, counts.counts)):
+        arrays[f'keys_{i}'] = keys
+        arrays[f'counts_{i}'] = table_counts
+    for name, array in arrays.items():
+        np.save(tmp / f'{name}.npy', array)
+    with (tmp / 'meta.pkl').open('wb') as f:
+        pickle.dump({'n': counts.n, 'window_size': counts.window_size, 'radix': counts.radix,
+                     'total': counts.total}, f)
+    try:
+        os.rename(tmp, path)
+    except OSError:  # another worker counted the same corpus first
+        shutil.rmtree(tmp, ignore_errors=True)
+    # Counts of earlier versions of the corpus; workers still reading them keep their open files.
+    prefix = path.name.rsplit('_', 1)[0]
+    for old in COUNTS_DIR.glob(f'{prefix}_*'):
+        if old != path:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def _read_ngram_counts(path: Path) -> Optional[NgramCounts]:
+    if path.name in _COUNTS_CACHE:
+        return _COUNTS_CACHE[path.name]
+    try:
+        with (path / 'meta.pkl').open('rb') as f:
+            meta = pickle.load(f)
+    except FileNotFoundError:
+        return None
+
+    def load(name: str) -> np.ndarray:
+        return np.load(path / f'{name}.npy', mmap_mode='r')
+
+    tables = range(len(FINDER_TABLES[meta['n']]))
+    counts = NgramCounts(**meta, word_counts=load('word_counts'), keys=[load(f'keys_{i}') for i in tables],
+                         counts=[load(f'counts_{i}') for i in tables], ngrams=load('ngrams'),
+                         postings=load('postings'), postings_start=load('postings_start'))
+    prefix = path.name.rsplit('_', 1)[0]
+    for name in [name for name in _COUNTS_CACHE if name.rsplit('_', 1)[0] == prefix]:
+        del _COUNTS_CACHE[name]  # drop the counts of earlier versions of the corpus and their open files
+    _COUNTS_CACHE[path.name] = counts
+    return counts
+
+
+def load_ngram_counts(n: int, window_size: int, include_examples: bool) -> Tuple[NgramCounts,
+                                                                                 corpus_index.Vocabulary]:
+    """Read the persisted counts for the current corpus, counting them first if the corpus changed."""
+    docs = corpus_index.load_docs(include_examples)
+    vocab = corpus_index.load_vocab()
+    path = _counts_dir(n, window_size, include_examples, docs)
+    counts = _read_ngram_counts(path)
+    if counts is None:
+        logger.debug(f'Counting {n}-grams in windows of {window_size}.')
+        counts = count_ngrams([doc.ids for doc in docs], n, window_size, len(vocab))
+        _write_ngram_counts(path, counts)
+    return counts, vocab
+
+
+def _lookup(keys: np.ndarray, counts: np.ndarray, wanted: np.ndarray) -> np.ndarray:
+    """Counts of the wanted keys in a sorted table; 0 for keys it does not have."""
+    if not len(keys):
+        return np.zeros(len(wanted), dtype=np.int64)
+    slots = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+    return np.where(keys[slots] == wanted, counts[slots], 0)
+
+
+def score_ngrams(counts: NgramCounts, score_fn: Callable, selected: np.ndarray,
+                 types: List[str]) -> List[Tuple[Tuple[str, ...], float, int]]:
+    """
+    Score the selected n-grams like the finder's score_ngrams() does, looking up only their own marginals.
+    :param selected: Indexes of the n-grams to score
+    :return: (n-gram, score, frequency), best first
+    """
+    ngrams = counts.ngrams[selected]
+    freqs = counts.ngram_counts[selected]
+    groups = []
+    for group in SCORE_MARGINALS[counts.n]:
+        columns = []
+        for table, positions in group:
+            if table is None:
+                columns.append(counts.word_counts[ngrams[:, positions[0]]])
+            else:
+                wanted = _row_keys([ngrams[:, p] for p in positions], counts.radix)
+                columns.append(_lookup(counts.keys[table], counts.counts[table], wanted))
+        groups.append(np.stack(columns, axis=1).tolist() if columns else [])
+
+    results = []
+    for i, (row, freq) in enumerate(zip(ngrams.tolist(), freqs.tolist())):
+        # Bigram counts are scaled by 1 / (window_size - 1), following Church and Hanks (1990) as NLTK does.
+        observed = freq / (counts.window_size - 1.0) if counts.n == 2 else freq
+        score = score_fn(observed, *(tuple(group[i]) for group in groups), counts.total)
+        if score is not None:
+            results.append((tuple(types[w] for w in row), score, freq))
+    results.sort(key=lambda t: (-t[1], t[0]))
+    return results
+
 
 def get_collocates(ngram: str,
                    assoc_measure: str,
@@ -34,23 +339,20 @@ def get_collocates(ngram: str,
                    query: str = None,
                    freq_filter: int = 3,
                    window_size: int = None,
-                   limit: int = 1000) -> List[Tuple[str, str, int]]:
-    measures, finder = MEASURES_FINDERS_DICT.get(ngram)
-    texts = _get_texts(include_examples)
-    texts = _clean_texts(texts)
-    tokens = texts.split()
-    finder = finder.from_words(tokens, window_size=window_size)
-    if freq_filter:
-        finder.apply_freq_filter(freq_filter)
-    results = finder.score_ngrams(getattr(measures, assoc_measure))[:limit]
+                   limit: int = 1000,
+                   progress: Callable[[float], None] = None) -> List[Tuple[str, str, int]]:
+    measures, _ = MEASURES_FINDERS_DICT.get(ngram)
+    n = NGRAM_SIZES[ngram]
+    counts, vocab = load_ngram_counts(n, window_size or n, include_examples)
+    if progress:
+        progress(0.6)
     if query:
         logger.debug(query)
-        results = [result for result in results if query in (r.lower() for r in result[0])]  # case insensitive search
-    results = [(finder.ngram_fd[result[0]],) + result for result in results]  # get freq for each ngram
-    for i in range(len(results)):
-        result = list(results[i])
-        result[1] = f"({', '.join(result[1])})"
-        results[i] = result
-    return results
-
-
+        query = query.lower()  # case insensitive search
+        selected = counts.containing([i for i, t in enumerate(vocab.types) if t.lower() == query])
+    else:
+        selected = np.arange(len(counts.ngrams))
+    if freq_filter:
+        selected = selected[counts.ngram_counts[selected] >= freq_filter]
+    scored = score_ngrams(counts, getattr(measures, assoc_measure), selected, vocab.types)
+    return [[freq, f"({', '.join(ngram)})", score] for ngram, score, freq in scored[:limit]]
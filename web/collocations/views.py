@@ -3,31 +3,33 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
 from django.views.generic import View
 
-from .utils import get_collocates
+from jobs.views import JobMixin
 
 
-class CollocationView(LoginRequiredMixin, View):
+class CollocationView(LoginRequiredMixin, JobMixin, View):
     template_name = 'collocations/index.html'
-
-    def get(self, request, *args, **kwargs):
-        query = request.GET.get('query')
-        freq_filter = int(request.GET.get('freq_filter', 1))
-        ngram = request.GET.get('ngram')
-        assoc_measure = request.GET.get('assoc_measure')
-        window_size = int(request.GET.get('window_size', 1))
-        include_examples = request.GET.get('include_examples')
-        if ngram:
-            collocations = get_collocates(ngram,
-                                          assoc_measure,
-                                          include_examples,
-                                          query=query,
-                                          freq_filter=freq_filter,
-                                          window_size=window_size)
-            context = {
-                'collocations': collocations,
-            }
-            return render(self.request, self.template_name, context=context)
-        return render(self.request, self.template_name)
+    job_kind = 'collocations'
+
+    def get_job_params(self):
+        ngram = self.request.GET.get('ngram')
+        if not ngram:
+            return None
+        return {
+            'ngram': ngram,
+            'assoc_measure': self.request.GET.get('assoc_measure'),
+            'include_examples': bool(self.request.GET.get('include_examples')),
+            'query': self.request.GET.get('query'),
+            'freq_filter': int(self.request.GET.get('freq_filter', 1)),
+            'window_size': int(self.request.GET.get('window_size', 1)),
+        }
+
+    def render_job_result(self, result):
+        if result is None:
+            return render(self.request, self.template_name)
+        context = {
+            'collocations': result,
+        }
+        return render(self.request, self.template_name, context=context)
 
 
 
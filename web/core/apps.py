@@ -3,3 +3,13 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate, pre_migrate
+
+        from . import signals  # noqa: F401
+        from .pending import backfill_pending_roots
+        from .search import backfill_search_documents, create_trigram_extension
+        pre_migrate.connect(create_trigram_extension, sender=self)
+        post_migrate.connect(backfill_search_documents, sender=self)
+        post_migrate.connect(backfill_pending_roots, sender=self)
@@ -0,0 +1,162 @@
+"""
+In-memory autocomplete over headwords, their variants and roots.
+
+Each index keeps its terms sorted, so prefix matches are a binary search, plus a trigram -> terms map for
+substring matches. Results are ranked by corpus frequency, prefix matches first. Indexes are rebuilt when
+the dictionary changes: immediately in the process that made the change (see ``core.signals``), and
+within ``CHECK_INTERVAL`` seconds in the others, which compare a cheap fingerprint of the tables.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+from functools import lru_cache
+import heapq
+import logging
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db.models import Count, Max, Sum
+
+from .models import Headword, Sense
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 5  # seconds between fingerprint checks
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+
+def _trigrams(s: str) -> Iterable[str]:
+    return {s[i:i + 3] for i in range(len(s) - 2)}
+
+
+class AutocompleteIndex:
+    """
+    :param terms: (term, headword, frequency), where ``term`` is the headword itself or one of its variants
+    """
+    def __init__(self, terms: Iterable[Tuple[str, str, int]]):
+        terms = sorted({(term.lower(), headword, frequency) for term, headword, frequency in terms if term})
+        self.keys = [key for key, _, _ in terms]
+        self.headwords = [headword for _, headword, _ in terms]
+        self.frequencies = [frequency for _, _, frequency in terms]
+        self.trigrams: Dict[str, List[int]] = defaultdict(list)
+        for i, key in enumerate(self.keys):
+            for trigram in _trigrams(key):
+                self.trigrams[trigram].append(i)
+        self._search = lru_cache(maxsize=4096)(self._search)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _prefix_ids(self, q: str) -> range:
+        start = bisect_left(self.keys, q)
+        end = bisect_left(self.keys, q + '\U0010ffff', lo=start)
+        return range(start, end)
+
+    def _infix_ids(self, q: str) -> Iterable[int]:
+        if len(q) < 3:  # too short for trigrams, but a scan of the keys is still fast
+            return (i for i, key in enumerate(self.keys) if q in key)
+        postings = sorted((self.trigrams.get(t, []) for t in _trigrams(q)), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return (i for i in candidates if q in self.keys[i])
+
+    def _top(self, ids: Iterable[int], limit: int, exclude: set) -> List[str]:
+        """
+        The ``limit`` most frequent headwords among ``ids``, leaving out those in ``exclude``. A headword matched
+        by several of its variants takes several of the best ids, so more are fetched until enough are distinct.
+        """
+        ids = list(ids)
+        fetch = limit + len(exclude)
+        while True:
+            result = []
+            seen = set(exclude)
+            for i in heapq.nlargest(fetch, ids, key=lambda i: (self.frequencies[i], -i)):
+                headword = self.headwords[i]
+                if headword not in seen:
+                    seen.add(headword)
+                    result.append(headword)
+                    if len(result) == limit:
+                        break
+            if len(result) == limit or fetch >= len(ids):
+                exclude.update(result)
+                return result
+            fetch *= 2
+
+    def _search(self, q: str, limit: int) -> Tuple[str, ...]:
+        seen = set()
+        result = self._top(self._prefix_ids(q), limit, seen)
+        if len(result) < limit:
+            result += self._top(self._infix_ids(q), limit - len(result), seen)
+        return tuple(result)
+
+    def search(self, q: str, limit: int = DEFAULT_LIMIT) -> List[str]:
+        """Headwords whose headword or variant starts with, then contains, ``q``, most frequent first."""
+        q = q.strip().lower()
+        if not q:
+            return []
+        return list(self._search(q, min(limit, MAX_LIMIT)))
+
+
+def _fingerprint() -> tuple:
+    # Corpus frequencies are updated without touching modified_date, so they are summed as well.
+    headwords = Headword.objects.aggregate(count=Count('id'), modified=Max('modified_date'),
+                                           frequency=Sum('corpus_frequency'))
+    senses = Sense.objects.aggregate(count=Count('id'), modified=Max('modified_date'))
+    return tuple(headwords.values()) + tuple(senses.values())
+
+
+def _build(roots_only: bool) -> AutocompleteIndex:
+    headwords = Headword.objects.all()
+    if roots_only:
+        headwords = headwords.filter(is_root=True)
+    terms = []
+    for headword, variant, rank in headwords.values_list('headword', 'variant', 'corpus_frequency'):
+        terms.append((headword, headword, rank))
+        terms.extend((v, headword, rank) for v in variant)
+    return AutocompleteIndex(terms)
+
+
+class _Indexes:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._indexes: Dict[bool, AutocompleteIndex] = {}
+        self._fingerprint: Optional[tuple] = None
+        self._checked_at: Optional[float] = None
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._indexes.clear()
+            self._fingerprint = None
+            self._checked_at = None
+
+    def get(self, roots_only: bool) -> AutocompleteIndex:
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at > CHECK_INTERVAL:
+                fingerprint = _fingerprint()
+                if fingerprint != self._fingerprint:
+                    self._indexes.clear()
+                    self._fingerprint = fingerprint
+                self._checked_at = now
+            if roots_only not in self._indexes:
+                start = time.time()
+                self._indexes[roots_only] = _build(roots_only)
+                logger.debug(f'Built autocomplete index of {len(self._indexes[roots_only])} terms '
+                             f'in {time.time() - start:.2f}s.')
+            return self._indexes[roots_only]
+
+
+_indexes = _Indexes()
+
+
+def invalidate() -> None:
+    """Rebuild the indexes of this process on next use."""
+    _indexes.invalidate()
+
+
+def complete_headwords(q: str, limit: int = DEFAULT_LIMIT) -> List[str]:
+    return _indexes.get(roots_only=False).search(q, limit)
+
+
+def complete_roots(q: str, limit: int = DEFAULT_LIMIT) -> List[str]:
+    return _indexes.get(roots_only=True).search(q, limit)
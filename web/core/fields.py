@@ -0,0 +1,25 @@
+import json
+
+from django.db import models
+
+
+class JSONTextField(models.TextField):
+    """
+    JSON stored as text, so that it works on SQLite as well as PostgreSQL. Nothing queries into these values,
+    so ``jsonb`` would buy nothing. Keys are sorted, so equal values are stored alike.
+    """
+    def from_db_value(self, value, expression, connection):
+        return self.to_python(value)
+
+    def to_python(self, value):
+        if isinstance(value, str):
+            return json.loads(value)
+        return value
+
+    def get_prep_value(self, value):
+        if value is None:
+            return None
+        return json.dumps(value, sort_keys=True)
+
+    def value_to_string(self, obj):
+        return self.get_prep_value(self.value_from_object(obj))
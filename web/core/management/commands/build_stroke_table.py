@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import strokes
+
+
+class Command(BaseCommand):
+    help = 'Builds the Unihan stroke-count table used to sort meanings by stroke order'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--if-missing', action='store_true', help='Only build if the table does not exist yet')
+
+    def handle(self, *args, **options):
+        if options['if_missing'] and strokes.STROKES_PATH.exists():
+            self.stdout.write(f"{strokes.STROKES_PATH} already exists.")
+            return
+
+        self.stdout.write("Building stroke table from Unihan...")
+        start = time.time()
+        table = strokes.build_table()
+        built = time.time()
+        strokes.write_table(table)
+        written = time.time()
+        strokes.read_table()
+        loaded = time.time()
+        self.stdout.write(f"Done! {len(table)} characters. Reading Unihan took {built - start:.2f}s, "
+                          f"loading the table takes {loaded - written:.3f}s.")
@@ -1,4 +1,5 @@
 from pathlib import Path
+import time
 
 from django.core.management.base import BaseCommand
 import pandas as pd
@@ -6,6 +7,8 @@ from openpyxl import load_workbook
 
 from core.utils import load
 from core.models import Headword
+from core.staging import staged_reload
+from freqdist.utils import refresh_corpus_frequencies
 
 
 
@@ -27,15 +30,34 @@ class Command(BaseCommand):
         parser.add_argument('--items', type=Path, default=items_path)
         parser.add_argument('--meaning', type=Path, default=extra_meaning_path)
         parser.add_argument('--phrases', type=Path, default=extra_phrases_path)
+        parser.add_argument('--staged', action='store_true',
+                            help='Load into staging tables and swap them in at the end, so the site stays up')
 
     def handle(self, *args, **options):
-        Headword.objects.all().delete()
-
-        self.stdout.write("Deleted Headwords!")
-        self.stdout.write("Loading new data...")
-        # load(items_path=options['items'], extra_meaning_path=options['meaning'], extra_phrases_path=options['phrases'])
-        load(items_path=options['items'], combined_file=True, extra_phrases_path=options['phrases'])
-        self.stdout.write("Done!")
+        loaded = {}
+
+        def load_data():
+            # load(items_path=options['items'], extra_meaning_path=options['meaning'], extra_phrases_path=options['phrases'])
+            loaded['rows'] = load(items_path=options['items'], combined_file=True,
+                                  extra_phrases_path=options['phrases'])
+
+        start = time.time()
+        if options['staged']:
+            self.stdout.write("Loading new data into staging tables...")
+            staged_reload(load_data)
+            self.stdout.write("Swapped in new data!")
+        else:
+            Headword.objects.all().delete()
+
+            self.stdout.write("Deleted Headwords!")
+            self.stdout.write("Loading new data...")
+            load_data()
+        rows = loaded['rows']
+        elapsed = time.time() - start
+        self.stdout.write(f"Done! Loaded {rows} rows in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):.0f} rows/sec).")
+
+        self.stdout.write("Recounting corpus frequencies...")
+        refresh_corpus_frequencies()
 
     def convert_to_csv(self, path: Path) -> None:
         wb = load_workbook(path)
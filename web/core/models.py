@@ -6,6 +6,7 @@ from typing import Iterator, Set
 from django.db import models
 from django.urls import reverse
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 
 
 class Headword(models.Model):
@@ -16,6 +17,11 @@ class Headword(models.Model):
     created_date = models.DateField(default=datetime.date.today)
     modified_date = models.DateTimeField(auto_now=True)
     variant = ArrayField(models.CharField(max_length=255), default=list, blank=True)
+    search_document = models.TextField(blank=True, default="", editable=False)  # see core.search
+    # Occurrences in the uploaded texts of the headword and its variants, and of words with it as root.
+    # Maintained by freqdist.utils.
+    corpus_frequency = models.PositiveIntegerField(default=0, db_index=True, editable=False)
+    root_corpus_frequency = models.PositiveIntegerField(default=0, db_index=True, editable=False)
 
     def __str__(self):
         return self.headword
@@ -27,7 +33,9 @@ class Headword(models.Model):
         unique_together = ('headword', 'is_root')
         indexes = [
             models.Index(fields=['headword']),
-            models.Index(fields=['variant'])
+            models.Index(fields=['variant']),
+            models.Index(fields=['only_letters', 'id']),  # keyset pagination
+            GinIndex(fields=['search_document'], name='core_hw_search_trgm', opclasses=['gin_trgm_ops']),
         ]
 
     @staticmethod
@@ -149,6 +157,7 @@ class Sense(models.Model):
                      default=list)  # 標籤
     toda = models.CharField(max_length=255, blank=True, default="")
     truku = models.CharField(max_length=255, blank=True, default="")
+    root_pending = models.BooleanField(default=False, db_index=True, editable=False)  # see core.pending
 
     class Meta:
         unique_together = ('headword', 'headword_sense_no')
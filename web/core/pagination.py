@@ -0,0 +1,176 @@
+"""
+Keyset (cursor) pagination for the headword listings.
+
+Pages are fetched with ``WHERE (only_letters, id) > cursor ORDER BY only_letters, id LIMIT n`` instead of
+``OFFSET``, so deep pages cost the same as the first one and no ``COUNT`` is needed to render a page.
+Cursors also carry the position of their row, which keeps the row numbers of the old paginator. The last page and
+the letter jumps seek from the end or from the letter instead of counting the rows before them, so their position,
+and that of the pages reached from them, is unknown (``None``).
+"""
+import base64
+from dataclasses import dataclass
+import json
+import logging
+import string
+from typing import List, Optional
+
+from django.db import connections
+from django.db.models import Q
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+
+logger = logging.getLogger(__name__)
+
+ORDERING = ('only_letters', 'id')
+END = 'end'  # ``before`` value of the last page
+LETTERS = string.ascii_lowercase  # jump navigation
+
+
+def encode_cursor(only_letters: str, pk: int, position: Optional[int]) -> str:
+    return base64.urlsafe_b64encode(json.dumps([only_letters, pk, position]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Optional[tuple]:
+    try:
+        only_letters, pk, position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        return None
+    return only_letters, pk, position
+
+
+def estimate_count(qs: QuerySet) -> int:
+    """Row estimate of the query planner on PostgreSQL, which avoids scanning the rows. Exact elsewhere."""
+    connection = connections[qs.db]
+    if connection.vendor != 'postgresql':
+        return qs.count()
+    sql, params = qs.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]['Plan']['Plan Rows']
+
+
+@dataclass
+class KeysetPage:
+    object_list: List
+    number: Optional[int]  # None when the position is unknown
+    start_index: Optional[int]
+    has_previous: bool
+    has_next: bool
+    previous_cursor: str = ""
+    next_cursor: str = ""
+    is_keyset: bool = True
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """Paginate a queryset of headwords on ``(only_letters, id)``."""
+    def __init__(self, object_list: QuerySet, per_page: int):
+        self.object_list = object_list.order_by(*ORDERING)
+        self.per_page = per_page
+
+    @cached_property
+    def count_is_approximate(self) -> bool:
+        """
+        Only the whole table is estimated: the planner knows its size, while its guesses for filtered rows, e.g.
+        ``LIKE '%term%'`` search results, can be off by orders of magnitude.
+        """
+        return not self.object_list.query.where and connections[self.object_list.db].vendor == 'postgresql'
+
+    @cached_property
+    def count(self) -> int:
+        """The planner estimate for the unfiltered index, so that showing it costs no ``COUNT``. Exact otherwise."""
+        if self.count_is_approximate:
+            return estimate_count(self.object_list)
+        return self.object_list.count()
+
+    def _fetch(self, qs: QuerySet) -> tuple:
+        rows = list(qs[:self.per_page + 1])
+        return rows[:self.per_page], len(rows) > self.per_page
+
+    def _page(self, rows: list, position: Optional[int], has_previous: bool, has_next: bool) -> KeysetPage:
+        known = position is not None
+        page = KeysetPage(
+            object_list=rows,
+            number=position // self.per_page + 1 if known else None,
+            start_index=position + 1 if known else None,
+            has_previous=has_previous,
+            has_next=has_next,
+        )
+        if rows:
+            first, last = rows[0], rows[-1]
+            page.previous_cursor = encode_cursor(first.only_letters, first.pk, position)
+            page.next_cursor = encode_cursor(last.only_letters, last.pk,
+                                             position + len(rows) - 1 if known else None)
+        elif has_previous:  # jumped past the last headword
+            page.previous_cursor = END
+        return page
+
+    def page(self, after: str = "", before: str = "", letter: str = "") -> KeysetPage:
+        """
+        :param after: Cursor of the last row of the previous page
+        :param before: Cursor of the first row of the next page, or ``END`` for the last page
+        :param letter: Start at the first headword at or after this letter
+        """
+        qs = self.object_list
+        if before:
+            if before == END:
+                rows, has_previous = self._fetch(qs.reverse())
+                rows.reverse()
+                return self._page(rows, None if has_previous else 0, has_previous, False)
+            cursor = decode_cursor(before)
+            if cursor:
+                only_letters, pk, position = cursor
+                rows, has_previous = self._fetch(qs.filter(
+                    Q(only_letters__lt=only_letters) | Q(only_letters=only_letters, id__lt=pk)).reverse())
+                rows.reverse()
+                if position is not None:
+                    position = max(position - len(rows), 0)
+                elif not has_previous:  # back at the first page
+                    position = 0
+                return self._page(rows, position, has_previous, True)
+
+        if after:
+            cursor = decode_cursor(after)
+            if cursor:
+                only_letters, pk, position = cursor
+                rows, has_next = self._fetch(qs.filter(
+                    Q(only_letters__gt=only_letters) | Q(only_letters=only_letters, id__gt=pk)))
+                return self._page(rows, None if position is None else position + 1, True, has_next)
+
+        if letter:
+            has_previous = qs.filter(only_letters__lt=letter).exists()
+            rows, has_next = self._fetch(qs.filter(only_letters__gte=letter))
+            return self._page(rows, None if has_previous else 0, has_previous, has_next)
+
+        rows, has_next = self._fetch(qs)
+        return self._page(rows, 0, False, has_next)
+
+
+class KeysetPaginationMixin:
+    """
+    Use keyset pagination in a ListView unless the user sorted on another column, in which case the
+    default offset pagination is used.
+    """
+    def paginate_queryset(self, queryset, page_size):
+        if self.request.GET.get('order-by'):
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size)
+        page = paginator.page(
+            after=self.request.GET.get('after', ""),
+            before=self.request.GET.get('before', ""),
+            letter=self.request.GET.get('letter', ""),
+        )
+        return paginator, page, page.object_list, page.has_previous or page.has_next
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['letters'] = LETTERS
+        return context
@@ -0,0 +1,36 @@
+"""
+Roots that senses refer to but that have no root headword of their own yet ("pending" entries).
+
+Each sense stores whether its root is pending in ``Sense.root_pending``, so listing and counting them is
+an indexed read. The flag is set when a sense is saved and refreshed for the affected roots when root
+headwords change (see ``core.signals``), and for everything after bulk loads.
+"""
+import logging
+from typing import Iterable, Optional
+
+from django.db.models import Q
+
+from .models import Headword, Sense
+
+logger = logging.getLogger(__name__)
+
+
+def is_root_pending(root: str) -> bool:
+    return bool(root) and not Headword.objects.filter(is_root=True, headword=root).exists()
+
+
+def refresh_pending_roots(roots: Optional[Iterable[str]] = None) -> None:
+    """Recompute ``Sense.root_pending`` for senses with the given roots, or for all senses."""
+    senses = Sense.objects.all()
+    if roots is not None:
+        senses = senses.filter(root__in=list(roots))
+    root_entries = Headword.objects.filter(is_root=True).values('headword')
+    added = senses.filter(root_pending=False).exclude(root='').exclude(root__in=root_entries).update(
+        root_pending=True)
+    resolved = senses.filter(root_pending=True).filter(Q(root='') | Q(root__in=root_entries)).update(
+        root_pending=False)
+    logger.debug(f'Pending roots: {added} senses added, {resolved} resolved.')
+
+
+def backfill_pending_roots(**kwargs) -> None:
+    refresh_pending_roots()
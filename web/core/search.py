@@ -0,0 +1,126 @@
+"""
+Substring search over headwords, variants, meanings and roots.
+
+Every headword keeps a denormalized ``search_document``: its lowercased headword, variants and the
+meanings and roots of its senses, each wrapped in ``SEP``. Searches then become a single ``LIKE`` on the
+headword table, without joins or ``DISTINCT``. On PostgreSQL the column has a pg_trgm GIN index, which
+serves ``LIKE '%term%'`` patterns of three or more characters.
+"""
+from collections import defaultdict
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+from django.db import connections
+from django.db.models.query import QuerySet
+
+from .models import Headword, Sense
+
+logger = logging.getLogger(__name__)
+
+SEP = '\x1f'  # never part of a field, so matches cannot span two of them
+
+
+def build_search_document(headword: str, variant: Iterable[str], senses: Iterable[Tuple[str, str]]) -> str:
+    """
+    :param headword: The headword
+    :param variant: Its variants
+    :param senses: (meaning, root) of each of its senses
+    """
+    fields = [headword, *variant]
+    for meaning, root in senses:
+        fields.extend([meaning, root])
+    return SEP + SEP.join(f.lower() for f in fields if f) + SEP
+
+
+def refresh_search_documents(headword_ids: Optional[Iterable[int]] = None, batch_size: int = 1000) -> int:
+    """
+    Rebuild the search documents of the given headwords, or of all of them.
+    Needed after bulk loads, which bypass the signals that keep single edits in sync.
+    :return: The number of headwords that changed
+    """
+    headwords = Headword.objects.only('id', 'headword', 'variant', 'search_document')
+    senses = Sense.objects.all()
+    if headword_ids is not None:
+        headword_ids = list(headword_ids)
+        headwords = headwords.filter(pk__in=headword_ids)
+        senses = senses.filter(headword_id__in=headword_ids)
+
+    senses_by_headword = defaultdict(list)
+    for headword_id, meaning, root in senses.values_list('headword_id', 'meaning', 'root'):
+        senses_by_headword[headword_id].append((meaning, root))
+
+    changed = []
+    for headword in headwords:
+        document = build_search_document(headword.headword, headword.variant, senses_by_headword[headword.pk])
+        if document != headword.search_document:
+            headword.search_document = document
+            changed.append(headword)
+    # bulk_update leaves modified_date alone, so this does not count as an edit.
+    Headword.objects.bulk_update(changed, ['search_document'], batch_size=batch_size)
+    logger.debug(f'Refreshed {len(changed)} search documents.')
+    return len(changed)
+
+
+def filter_search(qs: QuerySet, search_filter: str, search_name: str) -> QuerySet:
+    """Filter headwords whose headword, variants, meanings or roots start with, end with or contain ``search_name``."""
+    term = search_name.lower()
+    if search_filter == 'startswith':
+        return qs.filter(search_document__contains=SEP + term)
+    if search_filter == 'endswith':
+        return qs.filter(search_document__contains=term + SEP)
+    if search_filter == 'contains':
+        return qs.filter(search_document__contains=term)
+    return qs
+
+
+def make_step(search_filter: str = "", search_name: str = "", search_root: str = "") -> Optional[dict]:
+    """
+    Describe one search refinement as a small JSON-serializable dict, or return None if it filters nothing.
+    Searches are stored in the session as lists of steps and rebuilt with :func:`build_queryset`.
+    """
+    step = {}
+    if search_root in ('exclude', 'only'):
+        step['root'] = search_root
+    if search_filter in ('startswith', 'endswith', 'contains', 'root-deriv'):
+        step['filter'] = search_filter
+        step['name'] = search_name
+    return step or None
+
+
+def _apply_step(qs: QuerySet, step: dict) -> QuerySet:
+    root = step.get('root')
+    if root == 'exclude':
+        qs = qs.filter(is_root=False)
+    elif root == 'only':
+        qs = qs.filter(is_root=True)
+
+    search_filter = step.get('filter')
+    if search_filter == 'root-deriv':
+        qs = qs.filter(senses__root__iexact=step['name'])
+    elif search_filter:
+        qs = filter_search(qs, search_filter, step['name'])
+    return qs
+
+
+def build_queryset(steps: List[dict]) -> QuerySet:
+    """Lazily rebuild the headwords matched by a list of search steps."""
+    qs = Headword.objects.all()
+    for step in steps:
+        qs = _apply_step(qs, step)
+    return qs.order_by('only_letters').distinct()
+
+
+def backfill_search_documents(**kwargs) -> None:
+    """Build the documents of headwords that have none, e.g. right after the field was added."""
+    missing = Headword.objects.filter(search_document='').values_list('pk', flat=True)
+    if missing.exists():
+        refresh_search_documents(missing)
+
+
+def create_trigram_extension(using: str = 'default', **kwargs) -> None:
+    """Install pg_trgm before migrations create the trigram index. No-op on other databases."""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
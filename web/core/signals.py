@@ -0,0 +1,64 @@
+import threading
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from . import autocomplete
+from .models import Headword, Sense
+from .pending import is_root_pending, refresh_pending_roots
+from .search import refresh_search_documents
+
+_pending = threading.local()
+
+
+def _refresh_pending() -> None:
+    headword_ids = _pending.__dict__.pop('headword_ids', set())
+    roots = _pending.__dict__.pop('roots', set())
+    if headword_ids:
+        refresh_search_documents(headword_ids)
+        autocomplete.invalidate()
+    if roots:
+        refresh_pending_roots(roots)
+
+
+def _schedule_refresh(headword_id: int = None, roots: set = ()) -> None:
+    """Refresh once the transaction commits, so cascading deletes refresh each headword only once."""
+    if headword_id is not None:
+        _pending.__dict__.setdefault('headword_ids', set()).add(headword_id)
+    _pending.__dict__.setdefault('roots', set()).update(roots)
+    transaction.on_commit(_refresh_pending)
+
+
+def _root_names(headword: Headword) -> set:
+    return {headword.headword} if headword.is_root else set()
+
+
+@receiver(pre_save, sender=Headword)
+def headword_saving(sender, instance, **kwargs):
+    previous = None
+    if instance.pk is not None:
+        previous = Headword.objects.filter(pk=instance.pk).only('headword', 'is_root').first()
+    instance._previous_roots = _root_names(previous) if previous else set()
+
+
+@receiver(post_save, sender=Headword)
+def headword_saved(sender, instance, **kwargs):
+    roots = _root_names(instance) ^ getattr(instance, '_previous_roots', set())
+    _schedule_refresh(instance.pk, roots)
+
+
+@receiver(post_delete, sender=Headword)
+def headword_deleted(sender, instance, **kwargs):
+    _schedule_refresh(roots=_root_names(instance))
+
+
+@receiver(pre_save, sender=Sense)
+def sense_saving(sender, instance, **kwargs):
+    instance.root_pending = is_root_pending(instance.root)
+
+
+@receiver(post_save, sender=Sense)
+@receiver(post_delete, sender=Sense)
+def sense_changed(sender, instance, **kwargs):
+    _schedule_refresh(instance.headword_id)
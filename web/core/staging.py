@@ -0,0 +1,139 @@
+"""
+Reload the dictionary into shadow tables and swap them in atomically (PostgreSQL only).
+
+The new data is loaded into copies of the core tables in a staging schema while readers keep using the
+live tables. The swap then moves the live tables out and the staged ones in within a single
+transaction, so readers see either the old or the new dictionary, never a partial one. The old rows are
+dropped with their schema instead of going through cascading deletes.
+"""
+from contextlib import contextmanager
+import logging
+import re
+from typing import Callable, Dict, List
+
+from django.db import connection, transaction
+
+from .models import Headword, Sense, Example, Phrase
+
+logger = logging.getLogger(__name__)
+
+STAGING_SCHEMA = 'core_staging'
+RETIRED_SCHEMA = 'core_retired'
+MODELS = [Headword, Sense, Example, Phrase]  # parents before children
+
+
+class StagingError(Exception):
+    pass
+
+
+def _tables() -> List[str]:
+    return [model._meta.db_table for model in MODELS]
+
+
+def _index_key(indexdef: str) -> str:
+    """Index definition without its name and schema, so live and staged indexes can be matched."""
+    indexdef = re.sub(r'^CREATE (UNIQUE )?INDEX \S+ ON ', r'CREATE \1INDEX ON ', indexdef)
+    return re.sub(rf'\b(public|{STAGING_SCHEMA})\.', '', indexdef)
+
+
+def _indexes(cursor, schema: str) -> Dict[str, str]:
+    cursor.execute(
+        'SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = %s AND tablename = ANY(%s)',
+        [schema, _tables()])
+    return {_index_key(indexdef): name for name, indexdef in cursor.fetchall()}
+
+
+def _foreign_keys(cursor, table: str) -> List[tuple]:
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'f'",
+        [f'public.{table}'])
+    return cursor.fetchall()
+
+
+def _check_no_outside_references(cursor) -> None:
+    """Tables outside the staged set would keep pointing at the retired tables after the swap."""
+    tables = [f'public.{t}' for t in _tables()]
+    cursor.execute(
+        "SELECT conrelid::regclass::text FROM pg_constraint WHERE contype = 'f' "
+        "AND confrelid = ANY(%s::regclass[]) AND NOT conrelid = ANY(%s::regclass[])",
+        [tables, tables])
+    outside = [row[0] for row in cursor.fetchall()]
+    if outside:
+        raise StagingError(f'Tables outside the dictionary reference it: {", ".join(outside)}')
+
+
+def _create_staging_tables(cursor) -> None:
+    cursor.execute(f'DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE')
+    cursor.execute(f'CREATE SCHEMA {STAGING_SCHEMA}')
+    for table in _tables():
+        # Copies columns, defaults (sharing the live id sequences), checks and indexes, but not foreign keys.
+        cursor.execute(f'CREATE TABLE {STAGING_SCHEMA}.{table} (LIKE public.{table} INCLUDING ALL)')
+
+
+def _add_foreign_keys(cursor, foreign_keys: Dict[str, List[tuple]]) -> None:
+    for table, constraints in foreign_keys.items():
+        for name, definition in constraints:
+            # References are unqualified, so they resolve to the staged tables through the search path.
+            cursor.execute(f'ALTER TABLE {STAGING_SCHEMA}.{table} ADD CONSTRAINT {name} {definition}')
+
+
+@contextmanager
+def _search_path(cursor, schema: str):
+    """Make unqualified table names, i.e. every ORM query, resolve to ``schema`` first."""
+    cursor.execute('SHOW search_path')
+    previous = cursor.fetchone()[0]
+    cursor.execute(f'SET search_path TO {schema}, {previous}')
+    try:
+        yield
+    finally:
+        cursor.execute(f'SET search_path TO {previous}')
+
+
+def _swap(cursor) -> None:
+    live_indexes = _indexes(cursor, 'public')
+    staged_indexes = _indexes(cursor, STAGING_SCHEMA)
+    with transaction.atomic():
+        cursor.execute(f'DROP SCHEMA IF EXISTS {RETIRED_SCHEMA} CASCADE')
+        cursor.execute(f'CREATE SCHEMA {RETIRED_SCHEMA}')
+        for table in _tables():
+            # Owned sequences move with their table; keep them in public since the staged ids use them.
+            cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [f'public.{table}', 'id'])
+            sequence = cursor.fetchone()[0]
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+            cursor.execute(f'ALTER TABLE public.{table} SET SCHEMA {RETIRED_SCHEMA}')
+            cursor.execute(f'ALTER TABLE {STAGING_SCHEMA}.{table} SET SCHEMA public')
+            cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY public.{table}.id')
+        # Give the staged indexes the names migrations know them by.
+        for key, staged_name in staged_indexes.items():
+            live_name = live_indexes.get(key)
+            if live_name and live_name != staged_name:
+                cursor.execute(f'ALTER INDEX public.{staged_name} RENAME TO {live_name}')
+
+
+def staged_reload(load: Callable[[], None]) -> None:
+    """
+    Run ``load`` against empty shadow copies of the dictionary tables, then swap them in.
+    :param load: Loads the new data through the ORM
+    """
+    if connection.vendor != 'postgresql':
+        raise StagingError('Staged reloads need PostgreSQL.')
+
+    with connection.cursor() as cursor:
+        _check_no_outside_references(cursor)
+        # Read before changing the search path, which would make the definitions schema-qualified.
+        foreign_keys = {table: _foreign_keys(cursor, table) for table in _tables()}
+        _create_staging_tables(cursor)
+        try:
+            with _search_path(cursor, STAGING_SCHEMA):
+                load()
+                _add_foreign_keys(cursor, foreign_keys)
+            for table in _tables():
+                cursor.execute(f'ANALYZE {STAGING_SCHEMA}.{table}')
+            logger.info('Staged tables loaded. Swapping...')
+            _swap(cursor)
+        finally:
+            cursor.execute(f'DROP SCHEMA IF EXISTS {STAGING_SCHEMA} CASCADE')
+        # Readers are already on the new tables; dropping the old ones replaces the cascading deletes.
+        cursor.execute(f'DROP SCHEMA IF EXISTS {RETIRED_SCHEMA} CASCADE')
+    logger.info('Swapped in the reloaded dictionary.')
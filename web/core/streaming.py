@@ -0,0 +1,4 @@
+class Echo:
+    """A file-like object that returns what is written, so that csv.writer can feed a streaming response."""
+    def write(self, value):
+        return value
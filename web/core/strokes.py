@@ -0,0 +1,80 @@
+"""
+Total stroke counts (Unihan ``kTotalStrokes``) of CJK characters, used to sort meanings by stroke order.
+The table is built once from the cihai database into a small artifact (see the ``build_stroke_table``
+command) and read from it on first use, so importing this module never opens or bootstraps Unihan.
+"""
+import logging
+import os
+from pathlib import Path
+import pickle
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+STROKES_PATH = Path(__file__).parent / 'static/core/strokes.pkl'
+
+_STROKES: Optional[Dict[int, str]] = None
+
+
+def build_table() -> Dict[int, str]:
+    """Read every stroke count from the cihai database, bootstrapping it if needed. Slow."""
+    from cihai.core import Cihai
+
+    c = Cihai()
+    if not c.unihan.is_bootstrapped:
+        c.unihan.bootstrap()
+    Unihan = c.unihan.sql.base.classes.Unihan
+    rows = c.unihan.sql.session.query(Unihan.char, Unihan.kTotalStrokes).filter(Unihan.kTotalStrokes.isnot(None))
+    return {ord(char): strokes for char, strokes in rows}
+
+
+def write_table(table: Dict[int, str], path: Path = STROKES_PATH) -> None:
+    """Write atomically so that workers never read a partial table."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def read_table(path: Path = STROKES_PATH) -> Dict[int, str]:
+    with path.open('rb') as f:
+        return pickle.load(f)
+
+
+def stroke_table() -> Dict[int, str]:
+    """Return the code point -> total strokes table, loading it on first use."""
+    global _STROKES
+    if _STROKES is None:
+        try:
+            _STROKES = read_table()
+        except FileNotFoundError:
+            logger.warning(f'{STROKES_PATH} not found. Building it from Unihan...')
+            _STROKES = build_table()
+            write_table(_STROKES)
+        logger.debug(f'Loaded stroke counts of {len(_STROKES)} characters.')
+    return _STROKES
+
+
+def get_char_strokes(s: str) -> Tuple[str, str]:
+    """
+    Return the strokes of the first CJK character and of all of them, e.g. ('樹/16', '樹/16,木/4').
+    Characters without a stroke count are skipped.
+    """
+    table = stroke_table()
+    all_char_strokes = [f"{char}/{table[ord(char)]}" for char in s if ord(char) in table]
+    if not all_char_strokes:
+        return "", ""
+    return all_char_strokes[0], ",".join(all_char_strokes)
+
+
+def get_char_strokes_many(meanings: Iterable[str]) -> List[Tuple[str, str]]:
+    """Batch version of :func:`get_char_strokes`. Repeated meanings are only computed once."""
+    computed = {}
+    result = []
+    for meaning in meanings:
+        if meaning not in computed:
+            computed[meaning] = get_char_strokes(meaning)
+        result.append(computed[meaning])
+    return result
@@ -1,3 +1,67 @@
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 
-# Create your tests here.
+from .autocomplete import AutocompleteIndex
+from .models import Headword, Sense
+from .search import refresh_search_documents
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class HeadwordListingQueryCountTests(TestCase):
+    """Rendering a page of headwords should take the same number of queries however many rows it shows."""
+
+    def setUp(self):
+        user = get_user_model().objects.create_user('tester', password='secret')
+        self.client.force_login(user)
+
+    def create_headwords(self, start: int, n: int) -> None:
+        for i in range(start, start + n):
+            headword = Headword.objects.create(headword=f'word{i:03}', only_letters=f'word{i:03}')
+            Sense.objects.create(headword=headword, headword_sense_no=1, meaning=f'meaning {i}')
+            Sense.objects.create(headword=headword, headword_sense_no=2, meaning=f'meaning {i}b')
+        refresh_search_documents()  # the signals only refresh on commit
+
+    def get(self, url: str, params: dict):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def assertConstantQueries(self, url: str, params: dict = None):
+        self.create_headwords(0, 5)
+        _, small = self.get(url, params or {})
+        self.create_headwords(5, 45)
+        response, large = self.get(url, params or {})
+        self.assertEqual(small, large)
+        self.assertEqual(len(response.context['headwords']), 50)
+
+    def test_index(self):
+        self.assertConstantQueries(reverse('core:index'))
+
+    def test_index_sorted_on_sense_field(self):
+        self.assertConstantQueries(reverse('core:index'), {'order-by': 'meaning', 'dir': 'desc'})
+
+    def test_search_results(self):
+        self.assertConstantQueries(reverse('core:results'),
+                                   {'search_reset': 'True', 'search_filter': 'contains', 'search_name': 'word'})
+
+    def test_search_results_sorted_on_sense_field(self):
+        self.assertConstantQueries(reverse('core:results'), {'search_reset': 'True', 'search_filter': 'contains',
+                                                             'search_name': 'word', 'order-by': 'root'})
+
+
+class AutocompleteIndexTests(SimpleTestCase):
+    def test_headword_with_several_matching_variants_takes_one_slot(self):
+        index = AutocompleteIndex([
+            ('abx', 'X', 30), ('aby', 'X', 30), ('abz', 'X', 30), ('abw', 'X', 30),
+            ('aba', 'Y', 20),
+            ('abb', 'Z', 10),
+        ])
+        self.assertEqual(index.search('ab', 3), ['X', 'Y', 'Z'])
+
+    def test_prefix_matches_before_infix_matches(self):
+        index = AutocompleteIndex([('xab', 'A', 100), ('abc', 'B', 1), ('ab', 'C', 2)])
+        self.assertEqual(index.search('ab', 3), ['C', 'B', 'A'])
@@ -1,3 +1,4 @@
+from collections import defaultdict
 import csv
 import datetime
 from dataclasses import dataclass
@@ -7,25 +8,24 @@ from pathlib import Path
 import re
 import time
 from tqdm import tqdm
-from typing import List, Optional, Tuple, Iterator, Set
+from typing import Iterable, List, Optional, Tuple, Iterator, Set
 
-from cihai.core import Cihai
 from django.http.request import HttpRequest
-from django.forms.models import model_to_dict
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.db.models import Max, Min, Prefetch
+from django.db.models.fields.files import FieldFile
 from django.db.models.query import QuerySet
 
 from .forms import SenseForm
 from .models import Headword, Sense, Phrase, Example
+from .pending import refresh_pending_roots
+from .search import refresh_search_documents
+from .strokes import get_char_strokes, get_char_strokes_many
 
 logger = logging.getLogger(__name__)
 
 SEP_RE = re.compile(r'[;；,]')
 
-C = Cihai()
-if not C.unihan.is_bootstrapped:
-    C.unihan.bootstrap()
-
 
 @dataclass
 class Entry:
@@ -100,10 +100,8 @@ def _clean_entry_for_combined(entry: dict) -> dict:
     headword_sense_no = entry.pop('sense_id_str').split('-')[0]
     # headword, headword_sense_no = _split_item_name(entry.pop('item_name'))
     root, root_sense_no = _split_item_name(entry.pop('item_root'))
-    char_strokes_first, char_strokes_all = get_char_strokes(entry['meaning'])
+    # Stroke counts are added in bulk by the loader, only for the senses it creates.
 
-    entry['char_strokes_first'] = char_strokes_first
-    entry['char_strokes_all'] = char_strokes_all
     # entry['only_letters'] = only_letters(headword)
     # entry['only_letters'] = entry.pop('word_str')
     entry['only_letters'] = headword
@@ -156,21 +154,6 @@ def _split_item_name(s: str) -> Tuple[str, int]:
     return headword, sense
 
 
-def get_char_strokes(s: str) -> Tuple[str, str]:
-    all_char_strokes = []
-    for char in s:
-        query = C.unihan.lookup_char(char)
-        glyph = query.first()
-        if glyph:
-            strokes = glyph.kTotalStrokes
-            all_char_strokes.append(f"{char}/{strokes}")
-    if not all_char_strokes:
-        return "", ""
-    first_char_stroke = all_char_strokes[0]
-    all_char_strokes = ",".join(all_char_strokes)
-    return first_char_stroke, all_char_strokes
-
-
 def build_autocomplete_response(qs: List[Headword]) -> List[str]:
     """
     Return an enumerated list of senses for a root Headword.
@@ -184,118 +167,112 @@ def only_letters(string) -> str:
     return "".join(char for char in string if char.isalpha() or char == ' ')
 
 
-def load_items_from_combined(file: str):
-    errors = []
-    start = time.time()
-
+def _parse_combined(file: str) -> Iterator[dict]:
     with open(file, encoding='utf-8-sig') as fp:
         reader = csv.reader(fp)
         header = next(reader)
-
-        # for idx, row in tqdm(enumerate(reader ,1)):
-        for idx, row in enumerate(tqdm(reader) ,1):
+        for row in tqdm(reader):
             row = [r.strip().replace('\n', '') for r in row]
-            new_entry = _clean_entry_for_combined(dict(zip(header, row)))
-            headword = new_entry.pop('headword')
-            variant = new_entry.pop('variant')
-            is_root = new_entry.pop('is_root')
-            only_lttrs = new_entry.pop('only_letters')
+            yield _clean_entry_for_combined(dict(zip(header, row)))
 
-            meaning = new_entry.pop('meaning')
-            headword_sense_no = new_entry.pop('headword_sense_no')
-            char_strokes_first = new_entry.pop('char_strokes_first')
-            char_strokes_all = new_entry.pop('char_strokes_all')
-            word_class = new_entry.pop('word_class')
-            meaning_en = new_entry.pop('meaning_en')
-            item_root = new_entry.pop('root')
-
-            headword, created = Headword.objects.get_or_create(
-                headword=headword,
-                # is_root=is_root,
-                defaults={
-                    'only_letters': only_lttrs,
-                    'variant': variant,
-                    'is_root': is_root,
-                    'user': new_entry.get('user'),
-                    'created_date': new_entry.get('created_date')
-                }       
-            )
-            if not created:
-                logger.debug(f'{headword.headword} already exists. Retrieving from DB.')
-
-            try:
-                sense, created = Sense.objects.get_or_create(
-                    headword=headword,
-                    meaning=meaning,
-                    defaults={
-                        'headword_sense_no': headword_sense_no,
-                        'char_strokes_first': char_strokes_first,
-                        'char_strokes_all': char_strokes_all,
-                        'word_class': word_class,
-                        'meaning_en': meaning_en,
-                        'root': item_root,
-                    }
-                )
-            
-            except IntegrityError as e:
-                sense, created = Sense.objects.get_or_create(
-                    headword=headword,
-                    meaning=meaning,
-                    defaults={
-                        'headword_sense_no': headword.senses.count() + 1,
-                        'char_strokes_first': char_strokes_first,
-                        'char_strokes_all': char_strokes_all,
-                        'word_class': word_class,
-                        'meaning_en': meaning_en,
-                        'root': item_root,
-                    }
-                )
 
-            sentence = new_entry.pop('sentence')
-            sentence_en = new_entry.pop('sentence_en')
-            sentence_ch = new_entry.pop('sentence_ch')
+def load_items_from_combined(file: str, batch_size: int = 1000) -> int:
+    """
+    Load the combined items CSV with a few bulk inserts instead of several queries per row.
+    Rows are first resolved against in-memory maps of headwords and senses (seeded with what is
+    already in the DB), then everything is written with bulk_create inside one transaction.
+    :return: The number of CSV rows processed
+    """
+    start = time.time()
 
-            phrase = new_entry.pop('phrase')
-            phrase_ch = new_entry.pop('phrase_ch')
-            phrase_en = new_entry.pop('phrase_en')
+    headwords = {h.headword: h for h in Headword.objects.all()}
+    senses = {(s.headword.headword, s.meaning): s for s in Sense.objects.select_related('headword')}
+    sense_nos = defaultdict(set)  # headword -> headword_sense_no in use
+    for (headword, _), sense in senses.items():
+        sense_nos[headword].add(sense.headword_sense_no)
 
-            # try:
-            #     sense = Sense.objects.create(headword=headword, **new_entry)
-            # except IntegrityError as e:
-            #     # Possibly caused by an extra space in item name that was eventually stripped during pre-processing.
-            #     logger.error(e, headword.headword, new_entry)
-            #     new_entry['headword_sense_no'] = headword.senses.count() + 1
-            #     sense = Sense.objects.create(headword=headword, **new_entry)
-            #     errors.append([idx + 1, headword, e])
+    new_headwords, new_senses, examples, phrases = [], [], [], []
+    idx = 0
+    for idx, new_entry in enumerate(_parse_combined(file), 1):
+        headword = new_entry['headword']
+        meaning = new_entry['meaning']
 
-            if sentence:
-                Example.objects.create(
-                    sense=sense,
-                    sentence=sentence,
-                    sentence_ch=sentence_ch,
-                    sentence_en=sentence_en,
-                )
-
-            if phrase:
-                Phrase.objects.create(
-                    sense=sense,
-                    phrase=phrase,
-                    phrase_ch=phrase_ch,
-                    phrase_en=phrase_en,
-                )
-
-            if idx % 500 == 0:
-                logger.debug(f'Processed {idx} rows...')
+        if headword not in headwords:
+            headwords[headword] = Headword(
+                headword=headword,
+                only_letters=new_entry['only_letters'],
+                variant=new_entry['variant'],
+                is_root=new_entry['is_root'],
+                user=new_entry.get('user'),
+                created_date=new_entry.get('created_date'),
+            )
+            new_headwords.append(headwords[headword])
+        else:
+            logger.debug(f'{headword} already exists. Retrieving from DB.')
+
+        key = (headword, meaning)
+        if key not in senses:
+            headword_sense_no = int(new_entry['headword_sense_no'] or 1)
+            if headword_sense_no in sense_nos[headword]:
+                # Possibly caused by an extra space in item name that was eventually stripped during pre-processing.
+                headword_sense_no = len(sense_nos[headword]) + 1
+                while headword_sense_no in sense_nos[headword]:
+                    headword_sense_no += 1
+            sense_nos[headword].add(headword_sense_no)
+            senses[key] = Sense(
+                meaning=meaning,
+                headword_sense_no=headword_sense_no,
+                word_class=new_entry['word_class'],
+                meaning_en=new_entry['meaning_en'],
+                root=new_entry['root'],
+            )
+            new_senses.append((headword, senses[key]))
+
+        if new_entry['sentence']:
+            examples.append((key, Example(
+                sentence=new_entry['sentence'],
+                sentence_ch=new_entry['sentence_ch'],
+                sentence_en=new_entry['sentence_en'],
+            )))
+
+        if new_entry['phrase']:
+            phrases.append((key, Phrase(
+                phrase=new_entry['phrase'],
+                phrase_ch=new_entry['phrase_ch'],
+                phrase_en=new_entry['phrase_en'],
+            )))
+
+    strokes = get_char_strokes_many(sense.meaning for _, sense in new_senses)
+    for (_, sense), (char_strokes_first, char_strokes_all) in zip(new_senses, strokes):
+        sense.char_strokes_first = char_strokes_first
+        sense.char_strokes_all = char_strokes_all
+
+    parsed = time.time()
+    logger.debug(f'Parsed {idx} rows in {datetime.timedelta(seconds=parsed - start)}. Writing to DB...')
+
+    with transaction.atomic():
+        Headword.objects.bulk_create(new_headwords, batch_size=batch_size)
+        # Not every backend returns primary keys from bulk_create, so they are read back instead.
+        headword_ids = dict(Headword.objects.values_list('headword', 'pk'))
+        for headword, sense in new_senses:
+            sense.headword_id = headword_ids[headword]
+        Sense.objects.bulk_create([sense for _, sense in new_senses], batch_size=batch_size)
+
+        sense_ids = {(hw, meaning): pk for hw, meaning, pk in
+                     Sense.objects.values_list('headword__headword', 'meaning', 'pk')}
+        for key, example in examples:
+            example.sense_id = sense_ids[key]
+        Example.objects.bulk_create([example for _, example in examples], batch_size=batch_size)
+        for key, phrase in phrases:
+            phrase.sense_id = sense_ids[key]
+        Phrase.objects.bulk_create([phrase for _, phrase in phrases], batch_size=batch_size)
 
-            if errors:
-                fname = f'items_errors_{datetime.datetime.now().strftime("%Y%m%d")}.csv'
-                error_path = Path('.').joinpath(fname)
-                with error_path.open('w') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(['row', 'headword', 'error'])
-                    writer.writerows(errors)
-                
-                logger.info(f'Error log written to {error_path.resolve()}')
+    end = time.time()
+    elapsed = end - start
+    logger.info(f'Loaded {idx} rows ({len(new_headwords)} headwords, {len(new_senses)} senses, '
+                f'{len(examples)} examples, {len(phrases)} phrases) in {datetime.timedelta(seconds=elapsed)} '
+                f'({idx / max(elapsed, 1e-9):.0f} rows/sec).')
+    return idx
 
 
 def load_items(file: str ="../seediq_items_updated-20210401-sung.csv"):
@@ -512,11 +489,12 @@ def load_extra_phrases(file='../seediq_extra_phrases_updated-20190617-sung.csv')
 def load(
     items_path: Optional[str] = None, combined_file: bool = True, 
     extra_meaning_path: Optional[str] = None, extra_phrases_path: Optional[str] = None
-    ) -> None:
+    ) -> Optional[int]:
 
     logger.debug('Starting load_items()')
+    rows = None
     if combined_file:
-        load_items_from_combined(file=items_path)
+        rows = load_items_from_combined(file=items_path)
     else:
         load_items(file=items_path)
     if extra_meaning_path:
@@ -525,12 +503,19 @@ def load(
     if extra_phrases_path:
         logger.debug('Starting load_extra_phrases()')
         load_extra_phrases(file=extra_phrases_path)
+    logger.debug('Refreshing search documents and pending roots...')
+    refresh_search_documents()
+    refresh_pending_roots()
+    return rows
 
 
-def gen_query_history(request: HttpRequest):
+def gen_query_history(request: HttpRequest, qs: QuerySet, steps: List[dict]):
+    """
+    Add a search to the session's history, which is used to export past results.
+    :param qs: The matched headwords, only counted
+    :param steps: The search steps that rebuild ``qs``
+    """
     logger.debug('Generating query history...')
-    qs_length = len(request.session.get('queryset'))
-
     history_list = request.session.get('history_list', [])
 
     search_name = request.GET.get('search_name', "")
@@ -540,14 +525,14 @@ def gen_query_history(request: HttpRequest):
     if not any([search_name, search_filter, search_root]):  # just ordering results
         return request
 
-    query_str = f"({qs_length} hits) " \
+    query_str = f"({qs.count()} hits) " \
                 f"<strong>Item</strong>: {search_name} | " \
                 f"<strong>Filter</strong>: {search_filter} | " \
                 f"<strong>Roots</strong>: {search_root}"
 
     query_dict = {
         'query_str': query_str,
-        'queryset': request.session.get('queryset')
+        'steps': steps,
     }
     history_list.append(query_dict)
     request.session['history_list'] = history_list
@@ -563,52 +548,94 @@ def sort_queryset(qs: QuerySet, request: HttpRequest):
         return qs
 
     if order_by in sense_fields:
-        order_by = f'senses__{order_by}'
+        # Ordering on the joined senses would list a headword once per sense, so sort on an aggregate instead.
+        aggregate = Max if direction == 'desc' else Min
+        qs = qs.annotate(sense_sort_key=aggregate(f'senses__{order_by}'))
+        order_by = 'sense_sort_key'
 
     if direction == 'desc':
         order_by = f'-{order_by}'
 
-    qs = qs.order_by(order_by)
+    qs = qs.order_by(order_by, 'id')
     return qs
 
 
+def prefetch_senses(qs: QuerySet) -> QuerySet:
+    """
+    Fetch the senses of a page of headwords in one query, as ``headword.sense_list``.
+    Templates use the list and its length, which never queries again.
+    """
+    return qs.prefetch_related(Prefetch('senses', queryset=Sense.objects.order_by('headword_sense_no'),
+                                        to_attr='sense_list'))
+
+
+RELATED_FIELDNAMES = list(SenseForm.Meta.fields) + [
+    'user', 'is_root', 'variant', 'hw_created_date', 'headword',
+    'sentence', 'sentence_en', 'sentence_ch', 'phrase', 'phrase_en', 'phrase_ch',
+]
+
+
+def _numbered(items: Iterable, attr: str) -> str:
+    return " ".join(f'({i}) {getattr(item, attr)}' for i, item in enumerate(items, 1) if getattr(item, attr))
+
+
+def _related_row(headword: Headword, sense: Sense) -> dict:
+    row = {}
+    for field in SenseForm.Meta.fields:
+        value = getattr(sense, field)
+        row[field] = value.name if isinstance(value, FieldFile) else value
+    row['tag'] = ",".join(sense.tag)
+    row['user'] = headword.user
+    row['is_root'] = headword.is_root
+    row['variant'] = headword.variant
+    row['hw_created_date'] = headword.created_date
+    row['headword'] = headword.headword
+
+    examples = sense.examples.all()
+    row['sentence'] = _numbered(examples, 'sentence')
+    row['sentence_en'] = _numbered(examples, 'sentence_en')
+    row['sentence_ch'] = _numbered(examples, 'sentence_ch')
+
+    phrases = sense.phrases.all()
+    row['phrase'] = _numbered(phrases, 'phrase')
+    row['phrase_en'] = _numbered(phrases, 'phrase_en')
+    row['phrase_ch'] = _numbered(phrases, 'phrase_ch')
+    return row
+
+
+def iter_related(qs: QuerySet, batch_size: int = 500) -> Iterator[dict]:
+    """
+    Yield one row per sense with data from related models, such as examples and phrases.
+    Headwords are fetched in batches with their senses, examples and phrases prefetched,
+    so the number of queries grows with the number of batches rather than the number of senses.
+    :param qs: A Headword queryset.
+    :param batch_size: Number of headwords fetched at a time.
+    :return:
+    """
+    ids = list(qs.values_list('pk', flat=True))
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        headwords = Headword.objects.filter(pk__in=batch).prefetch_related(
+            'senses',
+            Prefetch('senses__examples', queryset=Example.objects.order_by('pk')),
+            Prefetch('senses__phrases', queryset=Phrase.objects.order_by('pk')),
+        )
+        headwords = {headword.pk: headword for headword in headwords}
+        for pk in batch:
+            headword = headwords.get(pk)
+            if headword is None:  # deleted while exporting
+                continue
+            for sense in headword.senses.all():
+                yield _related_row(headword, sense)
+
+
 def get_related(qs: List[Headword]) -> List[dict]:
     """
     Get data from related models, such as examples and phrases.
     :param qs: A list of Headword objects.
     :return:
     """
-    fieldnames = SenseForm.Meta.fields
-    results = []
-    for headword in qs:
-        senses = headword.senses.all().values('id', *fieldnames)
-        head_dict = model_to_dict(headword, ('user', 'variant', 'is_root', 'created_date'))
-        head_dict['hw_created_date'] = head_dict.pop('created_date')
-
-        for sense in senses:
-            sense.update(head_dict)
-            sense['headword'] = headword.headword
-            sense['tag'] = ",".join(sense['tag'])
-            _id = sense.pop('id')
-
-            examples = Example.objects.filter(sense=_id)
-            sentence = [f'({i}) {ex.sentence}' for i, ex in enumerate(examples, 1) if ex.sentence]
-            sentence_en = [f'({i}) {ex.sentence_en}' for i, ex in enumerate(examples, 1) if ex.sentence_en]
-            sentence_ch = [f'({i}) {ex.sentence_ch}' for i, ex in enumerate(examples, 1) if ex.sentence_ch]
-            sense['sentence'] = " ".join(sentence)
-            sense['sentence_en'] = " ".join(sentence_en)
-            sense['sentence_ch'] = " ".join(sentence_ch)
-
-            phrases = Phrase.objects.filter(sense=_id)
-            phrase = [f'({i}) {ex.phrase}' for i, ex in enumerate(phrases, 1) if ex.phrase]
-            phrase_en = [f'({i}) {ex.phrase_en}' for i, ex in enumerate(phrases, 1) if ex.phrase_en]
-            phrase_ch = [f'({i}) {ex.phrase_ch}' for i, ex in enumerate(phrases, 1) if ex.phrase_ch]
-            sense['phrase'] = " ".join(phrase)
-            sense['phrase_en'] = " ".join(phrase_en)
-            sense['phrase_ch'] = " ".join(phrase_ch)
-
-            results.append(sense)
-    return results
+    return list(iter_related(qs))
 
 
 def _split_num_char(s):
@@ -1,40 +1,43 @@
 import csv
+from itertools import chain
 import logging
 import re
 
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q
 from django.db.models.functions import Lower
-from django.http import HttpResponse, JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render, redirect
 from django.views.generic import View, DeleteView, UpdateView
 from django.views.generic.list import ListView
 from django.urls import reverse_lazy
+from django.utils.cache import patch_cache_control
 from django.utils.encoding import escape_uri_path
 
+from .pagination import KeysetPaginationMixin
+from .streaming import Echo
 from .forms import HeadwordForm, SenseForm, SenseUpdateForm, ExampleFormset, PhraseFormset
 from core.models import Headword, Sense
-from core import utils
+from core import autocomplete, search, utils
 
 logger = logging.getLogger(__name__)
 print(logger)
 
 
-class IndexListView(LoginRequiredMixin, ListView):
+class IndexListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Headword
     paginate_by = 100
     context_object_name = 'headwords'
     template_name = 'core/index.html'
 
     def get_queryset(self):
-        qs = Headword.objects.order_by('only_letters').prefetch_related('senses')
+        qs = utils.prefetch_senses(Headword.objects.order_by('only_letters'))
         return utils.sort_queryset(qs, self.request)
 
 
-class SearchResultsListView(LoginRequiredMixin, ListView):
+class SearchResultsListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Headword
     paginate_by = 100
     context_object_name = 'headwords'
@@ -42,65 +45,35 @@ class SearchResultsListView(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         logger.debug(self.request.GET)
+        session = self.request.session
         reset = self.request.GET.get('search_reset')
         if reset:
             logger.debug('Resetting queryset!')
-            self.request.session.pop('search_root', False)
-            self.request.session.pop('history_list', False)
-            qs = Headword.objects.all().prefetch_related('senses')
-        else:
-            qs = self.request.session.get('queryset')
+            session.pop('search_root', False)
+            session.pop('history_list', False)
+            session.pop('search_steps', False)
 
         search_root = self.request.GET.get('search_root', "")
         if search_root:
-            if search_root == 'exclude':
-                logger.debug('Filtering roots.')
-                qs = qs.filter(is_root=False)
-            elif search_root == 'only':
-                logger.debug('Only including roots.')
-                qs = qs.filter(is_root=True)
-
-            self.request.session['search_root'] = search_root
+            session['search_root'] = search_root
         search_filter = self.request.GET.get('search_filter', "")
         search_name = self.request.GET.get('search_name', "")
 
-        self.request.session['search_filter'] = search_filter
-        self.request.session['search_name'] = search_name
-
-        if search_filter == 'startswith':
-            qs = qs.filter(
-                Q(headword__istartswith=search_name) |
-                Q(senses__meaning__istartswith=search_name) |
-                Q(variant__istartswith=search_name) | 
-                Q(senses__root__istartswith=search_name)           
-                )
-        elif search_filter == 'endswith':
-            qs = qs.filter(
-                Q(headword__iendswith=search_name) |
-                Q(senses__meaning__iendswith=search_name) |
-                Q(variant__iendswith=search_name) |
-                Q(senses__root__iendswith=search_name)           
-                )
-        elif search_filter == 'contains':
-            qs = qs.filter(
-                Q(headword__icontains=search_name) |
-                Q(senses__meaning__icontains=search_name) |
-                Q(variant__icontains=search_name) |
-                Q(senses__root__icontains=search_name)           
-                )
-        elif search_filter == 'root-deriv':
-            qs = qs.filter(
-                # Q(headword__icontains=search_name) |
-                Q(senses__root__iexact=search_name)           
-                )
-
-        qs = qs.order_by('only_letters').distinct()
-
-        self.request.session['queryset'] = qs
-        qs = utils.sort_queryset(qs, self.request)
-        utils.gen_query_history(self.request)
-
-        return qs
+        session['search_filter'] = search_filter
+        session['search_name'] = search_name
+
+        # The session only keeps the search steps; the queryset is rebuilt from them on each request.
+        steps = session.get('search_steps', [])
+        step = search.make_step(search_filter, search_name, search_root)
+        is_new_step = step is not None and (not steps or steps[-1] != step)
+        if is_new_step:
+            steps = steps + [step]
+            session['search_steps'] = steps
+
+        qs = search.build_queryset(steps)
+        if is_new_step:
+            utils.gen_query_history(self.request, qs, steps)
+        return utils.sort_queryset(utils.prefetch_senses(qs), self.request)
 
 
 class HeadwordUpdateView(LoginRequiredMixin, View):
@@ -253,76 +226,58 @@ class PendingListView(LoginRequiredMixin, ListView):
     def get(self, request, *args, **kwargs):
         if request.is_ajax():
             logger.debug('Ajax request received!')
-            queryset = self.get_queryset()
-            return JsonResponse({'pending_count': len(queryset)})
+            return JsonResponse({'pending_count': self.get_queryset().count()})
         else:
             return super().get(request, *args, **kwargs)
 
     def get_queryset(self):
-        roots = set(Sense.objects.all().values_list('root', flat=True).distinct())
-        headwords = set(Headword.objects.filter(is_root=True).values_list('headword', flat=True))
-        roots_without_entries = roots - headwords
-        roots_without_entries = sorted(filter(bool, roots_without_entries))
-        roots_without_entries = Sense.objects.filter(root__in=list(roots_without_entries)).order_by('root')
-        return roots_without_entries
+        return Sense.objects.filter(root_pending=True).select_related('headword').order_by('root')
 
 
-class RootAutoComplete(LoginRequiredMixin, View):
-    def get(self, *args, **kwargs):
-        logger.debug('Autocomplete Called')
-        q = self.request.GET.get('q')
-        logger.debug(q)
-        if q:
-            queryset = Headword.objects.filter(
-                Q(headword__icontains=q) &
-                Q(is_root=True)). \
-                values_list('headword', flat=True)
-        else:
-            queryset = None
+def _autocomplete_response(results: list) -> JsonResponse:
+    response = JsonResponse(results, safe=False)
+    # Lets the browser reuse answers while the user edits the same prefix.
+    patch_cache_control(response, private=True, max_age=60)
+    return response
 
-        logger.debug(queryset)
 
-        return JsonResponse(list(queryset), safe=False)
+def _autocomplete_limit(request) -> int:
+    try:
+        return int(request.GET.get('limit', autocomplete.DEFAULT_LIMIT))
+    except ValueError:
+        return autocomplete.DEFAULT_LIMIT
 
 
-class RootSenseAutoComplete(LoginRequiredMixin, View):
+class RootAutoComplete(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
-        logger.debug('Autocomplete Called')
-        q = self.request.GET.get('q')
-        logger.debug(q)
-        if q:
-            hw = Headword.objects.filter(
-                Q(headword__icontains=q) &
-                Q(is_root=True)).prefetch_related('senses').first()
-            hw = utils.build_autocomplete_response(hw)
-        else:
-            queryset = None
+        q = self.request.GET.get('q', "")
+        logger.debug(f'Root autocomplete called: {q}')
+        return _autocomplete_response(autocomplete.complete_roots(q, _autocomplete_limit(self.request)))
 
-        logger.debug(hw)
 
-        return JsonResponse(list(queryset), safe=False)
+class RootSenseAutoComplete(LoginRequiredMixin, View):
+    def get(self, *args, **kwargs):
+        q = self.request.GET.get('q', "")
+        logger.debug(f'Root sense autocomplete called: {q}')
+        roots = autocomplete.complete_roots(q, limit=1)
+        if not roots:
+            return _autocomplete_response([])
+        headwords = Headword.objects.filter(headword=roots[0], is_root=True).prefetch_related('senses')
+        return _autocomplete_response(utils.build_autocomplete_response(headwords))
 
 
 class HeadwordAutoComplete(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
-        logger.debug('Item name autocomplete called')
-        q = self.request.GET.get('q')
-        logger.debug(q)
-        if q:
-            queryset = Headword.objects.filter(headword__icontains=q).values_list('headword', flat=True)
-        else:
-            queryset = None
-
-        logger.debug(queryset)
-
-        return JsonResponse(list(queryset), safe=False)
+        q = self.request.GET.get('q', "")
+        logger.debug(f'Item name autocomplete called: {q}')
+        return _autocomplete_response(autocomplete.complete_headwords(q, _autocomplete_limit(self.request)))
 
 
 @login_required
 def export_search_to_csv(request, query_idx):
     query_dict = request.session.get('history_list')[query_idx]
 
-    queryset = query_dict['queryset']
+    queryset = search.build_queryset(query_dict['steps'])
     query_str = query_dict['query_str']
     # some chars aren't allowed in filenames
     query_str = query_str.replace(' | ', '_')
@@ -330,15 +285,11 @@ def export_search_to_csv(request, query_idx):
     filename = escape_uri_path(f'{query_str}.csv')
     logger.debug(query_str)
 
-    queryset = utils.get_related(queryset)
-    fieldnames = queryset[0].keys()
-    response = HttpResponse(content_type='text/csv')
+    writer = csv.DictWriter(Echo(), fieldnames=utils.RELATED_FIELDNAMES)
+    header = dict(zip(utils.RELATED_FIELDNAMES, utils.RELATED_FIELDNAMES))
+    rows = chain([header], utils.iter_related(queryset))
+    response = StreamingHttpResponse((writer.writerow(row) for row in rows), content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename="{filename}"'
-
-    writer = csv.DictWriter(response, fieldnames=fieldnames)
-    writer.writeheader()
-    for row in queryset:
-        writer.writerow(row)
     return response
 
 
@@ -3,3 +3,10 @@ from django.apps import AppConfig
 
 class FreqdistConfig(AppConfig):
     name = 'freqdist'
+
+    def ready(self):
+        from django.db.models.signals import post_migrate
+
+        from . import signals  # noqa: F401
+        from .utils import backfill_corpus_frequencies
+        post_migrate.connect(backfill_corpus_frequencies, sender=self)
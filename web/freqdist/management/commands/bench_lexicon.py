@@ -0,0 +1,68 @@
+import random
+import string
+import time
+from typing import List, Optional
+
+from django.core.management.base import BaseCommand
+
+from freqdist.utils import build_lexicon
+
+
+def _random_word(rng: random.Random) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 10)))
+
+
+def _linear_lookup(word: str, senses: List[dict]) -> Optional[dict]:
+    """The matching loop build_item_root_freq() used before the lexicon map."""
+    for sense in senses:
+        if word == sense['headword__headword'] or word in sense['headword__variant']:
+            return sense
+    return None
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks headword matching: linear scan over senses vs. the lexicon map'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--types', type=int, default=50000, help='Distinct word types in the corpus')
+        parser.add_argument('--headwords', type=int, default=10000)
+        parser.add_argument('--sample', type=int, default=500,
+                            help='Words timed with the linear scan; the total is extrapolated')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        senses = []
+        for _ in range(options['headwords']):
+            variant = [_random_word(rng) for _ in range(rng.randint(0, 2))]
+            senses.append({
+                'headword__headword': _random_word(rng),
+                'headword__variant': variant,
+                'root': _random_word(rng),
+                'focus': [],
+                'word_class': [],
+            })
+        # Roughly a third of the corpus types are dictionary forms.
+        forms = [s['headword__headword'] for s in senses]
+        words = [rng.choice(forms) if rng.random() < 0.3 else _random_word(rng) for _ in range(options['types'])]
+
+        sample = words[:options['sample']]
+        start = time.perf_counter()
+        linear = [_linear_lookup(w, senses) for w in sample]
+        linear_secs = (time.perf_counter() - start) / len(sample) * len(words)
+
+        start = time.perf_counter()
+        lexicon = build_lexicon(senses)
+        build_secs = time.perf_counter() - start
+        start = time.perf_counter()
+        hashed = [lexicon.get(w) for w in words]
+        lookup_secs = time.perf_counter() - start
+
+        assert linear == hashed[:len(sample)], 'Lexicon lookup disagrees with the linear scan'
+
+        hashed_secs = build_secs + lookup_secs
+        self.stdout.write(f"{len(words)} types, {len(senses)} headwords")
+        self.stdout.write(f"Linear scan (extrapolated from {len(sample)} words): {linear_secs:.2f}s")
+        self.stdout.write(f"Lexicon map: {hashed_secs * 1000:.1f}ms "
+                          f"(build {build_secs * 1000:.1f}ms, lookup {lookup_secs * 1000:.1f}ms)")
+        self.stdout.write(f"Speed-up: {linear_secs / hashed_secs:.0f}x")
@@ -1,12 +1,33 @@
+import codecs
+import hashlib
+import os
+from pathlib import Path
+import re
+import shutil
+import tempfile
+from typing import Iterator
+
 import chardet
+from chardet.universaldetector import UniversalDetector
 from django.db import models
 
+from core.fields import JSONTextField
+
+NORMALIZED_ENCODING = 'utf-8'
+WHITESPACE_RE = re.compile(r'\s')
+
 
 class TextFile(models.Model):
     name = models.CharField(max_length=255, blank=True)
     file = models.FileField(upload_to='uploads/freq/')
     encoding = models.CharField(max_length=255, blank=True)
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    word_freq = JSONTextField(default=dict, blank=True)  # token counts before vocab-aware lower-casing
+    word_num = models.PositiveIntegerField(default=0)
+    sent_num = models.PositiveIntegerField(default=0)
+    frequency_applied = models.BooleanField(default=False)  # counted in Headword.corpus_frequency
+    tokenizer_version = models.PositiveIntegerField(default=0)  # that made the counts above, 0 if not counted yet
+    content_hash = models.CharField(max_length=40, blank=True)  # names the text's tokens in the KWIC index
 
     @staticmethod
     def _open_with_correct_encoding(file: bytes):
@@ -14,8 +35,70 @@ class TextFile(models.Model):
         file = file.decode(encoding)
         return file
 
+    def normalize_encoding(self, chunk_size: int = 1 << 16) -> None:
+        """
+        Re-encode the uploaded file as UTF-8 once, so that it never has to be detected or converted again.
+        Detection only reads as much of the file as chardet needs, and the file is converted in chunks.
+        """
+        path = Path(self.file.path)
+        detector = UniversalDetector()
+        with path.open('rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                detector.feed(chunk)
+                if detector.done:
+                    break
+        encoding = detector.close().get('encoding') or NORMALIZED_ENCODING
+
+        if codecs.lookup(encoding).name not in ('utf-8', 'ascii'):
+            decoder = codecs.getincrementaldecoder(encoding)()
+            fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+            with path.open('rb') as src, os.fdopen(fd, 'wb') as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b''):
+                    dst.write(decoder.decode(chunk).encode(NORMALIZED_ENCODING))
+                dst.write(decoder.decode(b'', final=True).encode(NORMALIZED_ENCODING))
+            shutil.copymode(path, tmp)
+            os.replace(tmp, path)
+        self.encoding = NORMALIZED_ENCODING
+
+    def hash_content(self, chunk_size: int = 1 << 16) -> None:
+        """SHA-1 of the file once its encoding is normalized, so identical texts share their tokens."""
+        sha1 = hashlib.sha1()
+        with open(self.file.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+        self.content_hash = sha1.hexdigest()
+
+    def iter_lines(self) -> Iterator[str]:
+        """The lines ``str.splitlines()`` gives for the decoded file, read one at a time."""
+        with open(self.file.path, encoding=self.encoding or NORMALIZED_ENCODING, newline='\n') as f:
+            for line in f:
+                # Also split at the other line boundaries splitlines() knows; an empty line stays a line.
+                yield from line.splitlines() or ['']
+
+    def iter_text(self, chunk_size: int = 1 << 20) -> Iterator[str]:
+        """
+        Stream the text ``read_and_decode()`` returns in pieces of roughly ``chunk_size`` characters.
+        Pieces are cut in front of whitespace, so tokenizing or counting them one by one gives the same
+        tokens as the whole text.
+        """
+        parts, size = [], 0
+        for i, line in enumerate(self.iter_lines()):
+            if i:
+                parts.append('.')
+            parts.append(line)
+            size += len(line) + 1
+            if size >= chunk_size:
+                text = "".join(parts)
+                cut = max((m.start() for m in WHITESPACE_RE.finditer(text, len(text) // 2)), default=0)
+                if cut:
+                    yield text[:cut]
+                    text = text[cut:]
+                parts, size = [text], len(text)
+        if parts:
+            yield "".join(parts)
+
     def read_and_decode(self, as_list=False):
-        text = self.file.read().decode(self.encoding).splitlines()
+        lines = self.iter_lines()
         if as_list:
-            return text
-        return ".".join(text)
+            return list(lines)
+        return ".".join(lines)
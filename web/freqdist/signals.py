@@ -0,0 +1,58 @@
+import threading
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from core.models import Headword, Sense
+from jobs.models import Job
+
+# The fields that decide which words count for which headword.
+COUNTED_FIELDS = {
+    Headword: ('headword', 'variant'),
+    Sense: ('headword', 'root'),
+}
+
+_scheduled = threading.local()
+
+
+def _enqueue_refresh() -> None:
+    if getattr(_scheduled, 'refresh', False):  # once per transaction, however many rows changed
+        _scheduled.refresh = False
+        # A recount still waiting in the queue is reused, so it absorbs the changes made since it was queued.
+        Job.enqueue('corpus_frequencies', {}, reuse_running=False)
+
+
+def _schedule_refresh() -> None:
+    _scheduled.refresh = True
+    transaction.on_commit(_enqueue_refresh)
+
+
+def _counted_values(sender, instance) -> tuple:
+    return tuple(getattr(instance, sender._meta.get_field(name).attname) for name in COUNTED_FIELDS[sender])
+
+
+@receiver(pre_save, sender=Headword)
+@receiver(pre_save, sender=Sense)
+def dictionary_saving(sender, instance, update_fields=None, **kwargs):
+    instance._previous_counted = None
+    if update_fields is not None and not set(update_fields) & set(COUNTED_FIELDS[sender]):
+        instance._previous_counted = _counted_values(sender, instance)
+    elif instance.pk is not None:
+        previous = sender.objects.filter(pk=instance.pk).only(*COUNTED_FIELDS[sender]).first()
+        if previous is not None:
+            instance._previous_counted = _counted_values(sender, previous)
+
+
+@receiver(post_save, sender=Headword)
+@receiver(post_save, sender=Sense)
+def dictionary_saved(sender, instance, **kwargs):
+    """Headwords, variants and roots decide which words count for which headword, so recount in the background."""
+    if _counted_values(sender, instance) != getattr(instance, '_previous_counted', None):
+        _schedule_refresh()
+
+
+@receiver(post_delete, sender=Headword)
+@receiver(post_delete, sender=Sense)
+def dictionary_deleted(sender, **kwargs):
+    _schedule_refresh()
@@ -1,55 +1,176 @@
 from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+import datetime
+import fcntl
 import logging
 from itertools import chain
+import os
 from pathlib import Path
-import re
-import string
-from typing import Dict, List, Iterator, Set
+import pickle
+import tempfile
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import chardet
+from django.db import transaction
 from django.db.models import Q
-from zhon import hanzi
+import numpy as np
 
 from .models import TextFile
-from core.models import Headword, Example, Sense
+from core.models import Headword, Sense
+from kwic import index as kwic_index
+from kwic.tokenizer import TOKENIZER_VERSION, split_sentences, split_words, word_forms
 
 logger = logging.getLogger(__name__)
 
-sent_boundary = ['.', '。', '!', '！', '?', '？', ';', '；']
-SENT_BOUNDARY_RE = re.compile(rf'[{"".join(sent_boundary)}]')
-
-punctuations = hanzi.punctuation + string.punctuation
-PUNCTUATION_RE = re.compile(rf'[{"".join(punctuations)}]')
-
-
-def _remove_punctuation_and_norm(s: str, vocab: Set[str]) -> Iterator[str]:
-    """Keep capitalization for proper words found in dictionary."""
-    r = PUNCTUATION_RE.sub(' ', s).split()
-    r = [s.lower() if s not in vocab else s for s in r]
-    r = filter(lambda x: x.isascii() and not x.isdigit(), r)
-    return r
-
-
-def _has_content(s):
-    if not s:
-        return False
-    elif s.isspace():
-        return False
-    elif s == 'NULL':
-        return False
-    return True
-
-
-def _split_by_word_boundary(text):
-    return list(filter(_has_content, text.split()))
-
-
-def _split_by_sent_boundary(text: str):
-    r = list(filter(_has_content, (t.strip() for t in SENT_BOUNDARY_RE.split(text))))
-    # with open('test_dict_sent_split.txt', 'a') as f:
-    #     for s in r:
-    #         print(s, file=f)
-    return r
+COUNTS_PATH = Path(__file__).parent / 'static/freqdist/results/corpus_counts.pkl'
+if not COUNTS_PATH.parent.exists():
+    COUNTS_PATH.parent.mkdir(parents=True)
+COUNTS_LOCK_PATH = COUNTS_PATH.with_suffix('.lock')
+
+
+@dataclass
+class CorpusCounts:
+    """Running totals over all uploaded texts, kept in step with the per-file counts on TextFile."""
+    word_freq: Counter = field(default_factory=Counter)
+    word_num: int = 0
+    sent_num: int = 0
+    file_ids: Set[int] = field(default_factory=set)
+    tokenizer_version: int = 0
+
+
+def _norm_counts(counts: Dict[str, int], vocab: Set[str]) -> Counter:
+    """Apply vocab-aware lower-casing once per type rather than once per token."""
+    normed = Counter()
+    for word, freq in counts.items():
+        normed[word.lower() if word not in vocab else word] += freq
+    return normed
+
+
+def count_text(text: str) -> Tuple[Counter, int, int]:
+    """Return the raw token counts, number of words and number of sentences of a text."""
+    word_freq = Counter(word_forms(text))
+    word_num = len(split_words(text))
+    sent_num = len(split_sentences(text))
+    return word_freq, word_num, sent_num
+
+
+def count_tokens(ids: np.ndarray, types: List[str]) -> Counter:
+    """
+    Same counts as ``Counter(word_forms(text))``, from the token ids of the text. Tokens only split
+    the text further at punctuation, which word_forms() removes anyway, so every type is cleaned
+    once with its count instead of once per occurrence.
+    :param types: Token of each id
+    """
+    word_freq = Counter()
+    counts = np.bincount(ids) if len(ids) else np.empty(0, dtype=np.int64)
+    for i in np.flatnonzero(counts).tolist():
+        count = int(counts[i])
+        for word in word_forms(types[i]):
+            word_freq[word] += count
+    return word_freq
+
+
+@contextmanager
+def _locked_counts():
+    with COUNTS_LOCK_PATH.open('w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _read_counts() -> Optional[CorpusCounts]:
+    try:
+        with COUNTS_PATH.open('rb') as f:
+            return pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _write_counts(counts: CorpusCounts) -> None:
+    fd, tmp = tempfile.mkstemp(dir=COUNTS_PATH.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(counts, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, COUNTS_PATH)
+
+
+def store_file_counts(text_file: TextFile) -> None:
+    """Count a text once at upload time and add it to the corpus totals."""
+    # Words and sentences were counted when the text was tokenized, so the file is not read again.
+    doc = kwic_index.load_doc(text_file)
+    word_freq = count_tokens(doc.ids, kwic_index.load_vocab().types)
+    word_num, sent_num = doc.word_num, doc.sent_num
+    text_file.word_freq = dict(word_freq)
+    text_file.word_num = word_num
+    text_file.sent_num = sent_num
+    text_file.tokenizer_version = TOKENIZER_VERSION
+    text_file.save(update_fields=['word_freq', 'word_num', 'sent_num', 'tokenizer_version'])
+
+    with _locked_counts():
+        counts = _read_counts()
+        if counts is None or counts.tokenizer_version != TOKENIZER_VERSION:
+            return  # rebuilt from the per-file counts on next read
+        if text_file.pk in counts.file_ids:
+            # Counted again by a newer tokenizer. Dropping the file makes the next read merge the totals again.
+            counts.file_ids.discard(text_file.pk)
+            _write_counts(counts)
+            return
+        counts.word_freq.update(word_freq)
+        counts.word_num += word_num
+        counts.sent_num += sent_num
+        counts.file_ids.add(text_file.pk)
+        _write_counts(counts)
+
+
+def discard_file_counts(text_file: TextFile) -> None:
+    """Subtract a deleted text from the corpus totals."""
+    with _locked_counts():
+        counts = _read_counts()
+        if counts is None or text_file.pk not in counts.file_ids:
+            return
+        counts.word_freq.subtract(text_file.word_freq)
+        counts.word_freq = +counts.word_freq  # drop types that no longer occur
+        counts.word_num -= text_file.word_num
+        counts.sent_num -= text_file.sent_num
+        counts.file_ids.discard(text_file.pk)
+        _write_counts(counts)
+
+
+def clear_corpus_counts() -> None:
+    with _locked_counts():
+        _write_counts(CorpusCounts(tokenizer_version=TOKENIZER_VERSION))
+
+
+def _is_stale(text_file: TextFile) -> bool:
+    """Whether a text was counted by another tokenizer than KWIC and collocations use now, or never counted."""
+    return text_file.tokenizer_version != TOKENIZER_VERSION
+
+
+def _merge_file_counts() -> CorpusCounts:
+    counts = CorpusCounts(tokenizer_version=TOKENIZER_VERSION)
+    for text_file in TextFile.objects.all():
+        if _is_stale(text_file):
+            store_file_counts(text_file)
+        counts.word_freq.update(text_file.word_freq)
+        counts.word_num += text_file.word_num
+        counts.sent_num += text_file.sent_num
+        counts.file_ids.add(text_file.pk)
+    return counts
+
+
+def get_corpus_counts() -> CorpusCounts:
+    """Return the corpus totals, merging the per-file counts again only if the totals have drifted."""
+    file_ids = set(TextFile.objects.values_list('pk', flat=True))
+    counts = _read_counts()
+    if counts is not None and counts.file_ids == file_ids and counts.tokenizer_version == TOKENIZER_VERSION:
+        return counts
+    logger.debug('Corpus totals are stale. Merging per-file counts.')
+    counts = _merge_file_counts()
+    with _locked_counts():
+        _write_counts(counts)
+    return counts
 
 
 def _compile_attr_groups(word_details: List[dict], attr: str) -> Dict[str, List[dict]]:
@@ -78,68 +199,161 @@ def _compile_attr_groups(word_details: List[dict], attr: str) -> Dict[str, List[
     return groups
 
 
-def build_item_root_freq(include_examples: bool) -> dict:
-    word_freq = Counter()
-    root_freq = Counter()
-    vocab = Headword.get_vocab()
-
-    word_details, not_found = [], []
-
-    sent_num, word_num = 0, 0
-
-    files = TextFile.objects.all()
-
-    # Get text from uploaded files
-    for file in files:
-        text = file.read_and_decode()
+def build_lexicon(senses: Iterable[dict]) -> Dict[str, dict]:
+    """
+    Map every surface form (headword and each of its variants) to its sense attributes.
+    When a form belongs to several senses, the first one in ``senses`` wins.
+    :param senses: Sense values with 'headword__headword' and 'headword__variant' keys
+    :return: A dict for constant-time lookup of corpus words
+    """
+    lexicon = {}
+    for sense in senses:
+        lexicon.setdefault(sense.get('headword__headword'), sense)
+        for variant in sense.get('headword__variant') or []:
+            lexicon.setdefault(variant, sense)
+    return lexicon
 
-        sent_num += len(_split_by_sent_boundary(text))
-        word_num += len(_split_by_word_boundary(text))
-
-        text = _remove_punctuation_and_norm(text, vocab)
-        word_freq.update(text)
-
-    if include_examples:
-        examples = Example.objects.all().values_list('sentence', flat=True)
-        for text in examples:
-            sent_num += len(_split_by_sent_boundary(text))
-            word_num += len(_split_by_word_boundary(text))
-
-            text = _remove_punctuation_and_norm(text, vocab)
-            word_freq.update(text)
 
+def _headword_senses():
+    """One sense per headword, as used by the frequency table."""
     # One headword can have multiple senses. Use .distinct() to only count a headword once.
     # Some senses don't have a root, so get the earliest sense since it most likely has one.
-    senses = Sense.objects.all().select_related('headword').values(
+    return Sense.objects.all().select_related('headword').values(
         'root',
         'focus',
         'word_class',
+        'headword__id',
         'headword__headword',
         'headword__variant',
     ).order_by('headword__headword', '-root').distinct('headword__headword')
 
+
+def _headword_frequencies(word_freq: Dict[str, int], vocab: Set[str], lexicon: Dict[str, dict]) -> Tuple[Counter, Counter]:
+    """
+    Attribute raw token counts to headwords the same way the frequency table does.
+    :return: Frequencies by headword id, and by root name
+    """
+    freq, root_freq = Counter(), Counter()
+    for word, n in _norm_counts(word_freq, vocab).items():
+        sense = lexicon.get(word)
+        if sense:
+            freq[sense['headword__id']] += n
+            if sense['root']:
+                root_freq[sense['root']] += n
+    return freq, root_freq
+
+
+def _apply_file_frequencies(text_file: TextFile, sign: int) -> None:
+    with transaction.atomic():
+        # Locking the file row serializes this with refresh_corpus_frequencies() for the same file.
+        applied = TextFile.objects.select_for_update().filter(pk=text_file.pk).values_list(
+            'frequency_applied', flat=True).first()
+        if applied is None or applied == (sign > 0):
+            return
+        freq, root_freq = _headword_frequencies(text_file.word_freq, Headword.get_vocab(),
+                                                build_lexicon(_headword_senses()))
+        headwords = list(Headword.objects.select_for_update().filter(
+            Q(pk__in=list(freq)) | Q(headword__in=list(root_freq))).only(
+            'id', 'headword', 'corpus_frequency', 'root_corpus_frequency'))
+        for headword in headwords:
+            headword.corpus_frequency = max(headword.corpus_frequency + sign * freq[headword.pk], 0)
+            headword.root_corpus_frequency = max(
+                headword.root_corpus_frequency + sign * root_freq[headword.headword], 0)
+        Headword.objects.bulk_update(headwords, ['corpus_frequency', 'root_corpus_frequency'], batch_size=1000)
+        TextFile.objects.filter(pk=text_file.pk).update(frequency_applied=sign > 0)
+    logger.debug(f'Applied the counts of {text_file.name} to {len(headwords)} headwords.')
+
+
+def add_corpus_frequencies(text_file: TextFile) -> None:
+    """Add an uploaded text to Headword.corpus_frequency, after store_file_counts()."""
+    _apply_file_frequencies(text_file, 1)
+
+
+def subtract_corpus_frequencies(text_file: TextFile) -> None:
+    """Remove a text from Headword.corpus_frequency, before it is deleted."""
+    _apply_file_frequencies(text_file, -1)
+
+
+def clear_corpus_frequencies() -> None:
+    Headword.objects.exclude(corpus_frequency=0, root_corpus_frequency=0).update(
+        corpus_frequency=0, root_corpus_frequency=0)
+
+
+def refresh_corpus_frequencies(progress: Callable[[float], None] = None) -> int:
+    """
+    Recompute Headword.corpus_frequency from the corpus totals, e.g. after the dictionary changed, which
+    changes how words map to headwords, or after the tokenizer changed. Only reads the stored counts and
+    the counts of texts counted by an earlier tokenizer, not the texts.
+    :return: The number of headwords that changed
+    """
+    for text_file in TextFile.objects.exclude(tokenizer_version=TOKENIZER_VERSION):
+        store_file_counts(text_file)
+    counts = get_corpus_counts()
+    freq, root_freq = _headword_frequencies(counts.word_freq, Headword.get_vocab(),
+                                            build_lexicon(_headword_senses()))
+    if progress:
+        progress(0.5)
+    with transaction.atomic():
+        TextFile.objects.select_for_update().filter(pk__in=counts.file_ids).update(frequency_applied=True)
+        changed = []
+        for headword in Headword.objects.select_for_update().only(
+                'id', 'headword', 'corpus_frequency', 'root_corpus_frequency'):
+            values = freq[headword.pk], root_freq[headword.headword]
+            if values != (headword.corpus_frequency, headword.root_corpus_frequency):
+                headword.corpus_frequency, headword.root_corpus_frequency = values
+                changed.append(headword)
+        Headword.objects.bulk_update(changed, ['corpus_frequency', 'root_corpus_frequency'], batch_size=1000)
+    logger.debug(f'Refreshed the corpus frequencies of {len(changed)} headwords.')
+    return len(changed)
+
+
+def refresh_stale_counts() -> None:
+    """Recount texts counted by an earlier tokenizer, and the corpus frequencies with them."""
+    if TextFile.objects.exclude(tokenizer_version=TOKENIZER_VERSION).exists():
+        refresh_corpus_frequencies()
+
+
+def backfill_corpus_frequencies(**kwargs) -> None:
+    if TextFile.objects.filter(Q(frequency_applied=False) | ~Q(tokenizer_version=TOKENIZER_VERSION)).exists():
+        refresh_corpus_frequencies()
+
+
+def build_item_root_freq(include_examples: bool, progress: Callable[[float], None] = None) -> dict:
+    root_freq = Counter()
+    vocab = Headword.get_vocab()
+
+    word_details, not_found = [], []
+
+    # Counts of uploaded files are stored per file at upload time, so only the totals are merged here.
+    refresh_stale_counts()
+    counts = get_corpus_counts()
+    word_freq = _norm_counts(counts.word_freq, vocab)
+    sent_num, word_num = counts.sent_num, counts.word_num
+
+    if include_examples:
+        examples = kwic_index.load_examples_doc()
+        word_freq.update(_norm_counts(count_tokens(examples.ids, kwic_index.load_vocab().types), vocab))
+        sent_num += examples.sent_num
+        word_num += examples.word_num
+
+    lexicon = build_lexicon(_headword_senses())
+
     for idx, (word, freq) in enumerate(word_freq.items()):
-        for sense in senses:
-            hw = sense.get('headword__headword')
-            variant = sense.get('headword__variant')
-            if word == hw or word in variant:
-                query = sense
-                root = query.get('root')
-                focus = query.get('focus')
-                word_class = query.get('word_class')
-                if root:
-                    root_freq[root] += freq
-
-                word_details.append({
-                    'item_name': word,
-                    'item_freq': freq,
-                    'root': root,
-                    'root_freq': None,
-                    'focus': focus,
-                    'word_class': word_class,
-                    'variant': variant,
-                })
-                break
+        sense = lexicon.get(word)
+        if sense:
+            root = sense.get('root')
+            if root:
+                root_freq[root] += freq
+
+            word_details.append({
+                'item_name': word,
+                'item_freq': freq,
+                'root': root,
+                'root_freq': None,
+                'focus': sense.get('focus'),
+                'word_class': sense.get('word_class'),
+                'variant': sense.get('headword__variant'),
+            })
         else:
             not_found.append({
                 'item_name': word,
@@ -152,6 +366,8 @@ def build_item_root_freq(include_examples: bool) -> dict:
             })
         if idx % 500 == 0:
             logger.debug(f"Completed {idx} of {len(word_freq)}")
+            if progress:
+                progress(idx / len(word_freq))
 
     for word in word_details:
         word['root_freq'] = root_freq.get(word['root'])
@@ -167,16 +383,21 @@ def build_item_root_freq(include_examples: bool) -> dict:
         'word_num': word_num,
         'sent_num': sent_num,
         'include_examples': include_examples,
+        'date': datetime.datetime.now(),
     }
     return results
 
 
-def calculate_coverage() -> List[dict]:
+def calculate_coverage(progress: Callable[[float], None] = None) -> List[dict]:
     results = []
+    refresh_stale_counts()
     files = TextFile.objects.all()
     vocab = Headword.get_vocab()
-    for f in files:
-        text = set(_remove_punctuation_and_norm(f.read_and_decode(), vocab))
+    for idx, f in enumerate(files):
+        if progress:
+            progress(idx / len(files))
+        # The stored counts hold every token of the text, so the file itself is not read again.
+        text = set(_norm_counts(f.word_freq, vocab))
         covered_vocab = vocab.intersection(text)
         coverage_percent = round(len(covered_vocab) / len(text) * 100, 2)
         not_covered = list(text.difference(vocab))
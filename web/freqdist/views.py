@@ -1,34 +1,29 @@
 import csv
-import datetime
 import logging
 from itertools import chain
-import pickle
 from typing import List
 
 from pathlib import Path
 
-import chardet
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
 from django.views import View
 from django.views.generic import DeleteView
-from django.shortcuts import render, redirect
+from django.shortcuts import render, redirect, get_object_or_404
 from django.http import JsonResponse, HttpResponse
 from django.urls import reverse_lazy, reverse
 from django.utils.http import urlencode
 
+from jobs.cache import results_cache
+from jobs.models import Job
+from jobs.views import JobMixin, enqueue_and_redirect, render_pending
+from kwic import index as kwic_index
 from .forms import TextFileUploadForm
 from .models import TextFile
 from . import utils
 
-RESULTS_DIR = Path(settings.BASE_DIR) / 'freqdist' / 'static' / 'freqdist' / 'results'
-if not RESULTS_DIR.exists():
-    RESULTS_DIR.mkdir(parents=True)
-FILE_NAME = 'freq_results.pkl'
-FILE_PATH = RESULTS_DIR.joinpath(FILE_NAME)
-
 logger = logging.getLogger(__name__)
 
 
@@ -47,8 +42,13 @@ class TextFileUploadView(LoginRequiredMixin, View):
             for file in self.request.FILES.getlist('file'):
                 text_file = TextFile(file=file)
                 text_file.name = file.name
-                text_file.encoding = chardet.detect(file).get('encoding')
                 text_file.save()
+                text_file.normalize_encoding()
+                text_file.hash_content()
+                text_file.save(update_fields=['encoding', 'content_hash'])
+                kwic_index.index_text_file(text_file)
+                utils.store_file_counts(text_file)
+                utils.add_corpus_frequencies(text_file)
 
         return redirect(reverse('freqdist:upload'))
 
@@ -63,6 +63,9 @@ class TextSingleDeleteView(LoginRequiredMixin, DeleteView):
         path = Path(obj.file.path)
         if path.exists():
             path.unlink()
+        kwic_index.remove_text_file(obj)
+        utils.discard_file_counts(obj)
+        utils.subtract_corpus_frequencies(obj)
         messages.success(request, self.success_message)
         return super().delete(request, *args, **kwargs)
 
@@ -76,6 +79,9 @@ class TextAllDeleteView(LoginRequiredMixin, View):
         texts_path = Path(settings.MEDIA_ROOT) / 'freq'
         for text in texts_path.iterdir():
             text.unlink()
+        kwic_index.clear_index()
+        utils.clear_corpus_counts()
+        utils.clear_corpus_frequencies()
         messages.success(request, self.success_message)
         return redirect(self.success_url)
 
@@ -84,22 +90,32 @@ class FreqResultsView(LoginRequiredMixin, View):
     selected_group = None
 
     def get(self, request, *args, **kwargs):
+        job_id = request.GET.get('job')
+        if job_id:
+            job = get_object_or_404(Job, pk=job_id)
+            if not job.is_finished:
+                return render_pending(request, job)
+            if job.status == Job.StatusChoices.FAILED.value:
+                messages.error(request, 'Something happened. Please try again.')
+            return redirect(request.path)
+
         group_list = ['word_class_groups', 'focus_groups']
         group_list.remove(self.selected_group)
         recalculate = request.GET.get('recalculate')
-        include_examples = request.GET.get('includeExamples') == 'True'
+        if recalculate:
+            include_examples = request.GET.get('includeExamples') == 'True'
+            request.session['freq_include_examples'] = include_examples
+        else:
+            include_examples = request.session.get('freq_include_examples', False)
         sort_key = request.GET.get('order-by')
         sort_dir = request.GET.get('dir') == 'desc'
 
-        if recalculate or not FILE_PATH.exists():
-            results = utils.build_item_root_freq(include_examples)
-            now = datetime.datetime.now()
-            results['date'] = now
-            with FILE_PATH.open('wb') as f:
-                pickle.dump(results, f)
-        else:
-            with FILE_PATH.open('rb') as f:
-                results = pickle.load(f)
+        # Results are cached per corpus version, so a cache hit is always up to date.
+        params = {'include_examples': include_examples}
+        result_key = results_cache.make_key('freq', params)
+        results = results_cache.get(result_key)
+        if results is None:
+            return enqueue_and_redirect(request, 'freq', params)
 
         if sort_key:
             for key in results[self.selected_group]:
@@ -110,6 +126,7 @@ class FreqResultsView(LoginRequiredMixin, View):
 
         results['groups'] = results.pop(self.selected_group)
         results['selected_group'] = self.selected_group
+        results['result_key'] = result_key
         for key in group_list:
             results.pop(key)
 
@@ -124,15 +141,18 @@ class FreqResultsMorphoView(FreqResultsView):
     selected_group = "focus_groups"
 
 
-class CoverageView(LoginRequiredMixin, View):
+class CoverageView(LoginRequiredMixin, JobMixin, View):
     template_name = "freqdist/coverage.html"
+    job_kind = 'coverage'
 
-    def get(self, request, *args, **kwargs):
-        coverage = utils.calculate_coverage()
+    def get_job_params(self):
+        return {}
+
+    def render_job_result(self, result):
         context = {
-            'coverage_list': coverage,
+            'coverage_list': result,
         }
-        return render(request, self.template_name, context=context)
+        return render(self.request, self.template_name, context=context)
 
 
 def _format_csv_rows(results: List[dict]) -> List[dict]:
@@ -148,8 +168,10 @@ def _format_csv_rows(results: List[dict]) -> List[dict]:
 
 @login_required
 def export_results_to_csv(request):
-    with FILE_PATH.open('rb') as f:
-        results = pickle.load(f)
+    results = results_cache.get(request.GET.get('result_key', ''))
+    if results is None:
+        messages.error(request, 'These results have expired. Please try again.')
+        return redirect('freq:results_word_class')
     group = request.GET.get('group')  # e.g. word_class or morphological (focus)
     tab = request.GET.get('tab')  # e.g. nouns or verbs
     date = results.get('date').strftime('%Y%m%d')
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+import pickle
+import re
+import tempfile
+import time
+from typing import Any, Optional
+
+from django.conf import settings
+from django.db.models import Count, Max
+
+from core.models import Headword, Sense, Example
+from freqdist.models import TextFile
+from kwic.tokenizer import TOKENIZER_VERSION
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DIR = Path(getattr(settings, 'RESULTS_CACHE_DIR', Path(settings.BASE_DIR) / 'data/results'))
+if not RESULTS_DIR.exists():
+    RESULTS_DIR.mkdir(parents=True)
+
+KEY_RE = re.compile(r'^[0-9a-f]{40}$')  # make_key() digests; keys also arrive from query strings
+
+
+def corpus_version() -> str:
+    """Fingerprint of everything an analysis reads: the uploaded texts, how they are tokenized and the dictionary."""
+    parts = [TOKENIZER_VERSION, list(TextFile.objects.order_by('pk').values_list('pk', 'uploaded_at'))]
+    for model in (Headword, Sense, Example):
+        parts.append(model.objects.aggregate(count=Count('id'), modified=Max('modified_date')))
+    return hashlib.sha1(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def _unlink(path: Path) -> None:
+    try:
+        path.unlink()
+    except FileNotFoundError:
+        pass  # already removed by another worker
+
+
+class ResultCache:
+    """
+    Analysis results on disk, keyed by the query parameters and the corpus version.
+    Entries expire after ``ttl`` seconds and the least recently used ones are evicted beyond ``max_entries``.
+    """
+    def __init__(self, directory: Path, max_entries: int, ttl: int):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+    @staticmethod
+    def make_key(kind: str, params: dict) -> str:
+        payload = json.dumps([kind, params, corpus_version()], sort_keys=True, default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        if not KEY_RE.match(key):
+            raise ValueError(f'Invalid results cache key: {key!r}')
+        return self.directory / f'{key}.pkl'
+
+    def get(self, key: str) -> Optional[Any]:
+        """The cached value, or None if there is none or ``key`` is not a key this cache could have made."""
+        try:
+            path = self._path(key)
+        except ValueError:
+            return None
+        try:
+            with path.open('rb') as f:
+                created, value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        if time.time() - created > self.ttl:
+            _unlink(path)
+            return None
+        os.utime(path)  # the modification time doubles as the last access time for LRU eviction
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        """Write atomically so that readers never see a partial result."""
+        path = self._path(key)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time(), value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self) -> None:
+        now = time.time()
+        entries = []
+        for path in self.directory.glob('*.pkl'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                _unlink(path)
+            else:
+                entries.append((stat.st_mtime, path))
+        entries.sort()
+        for _, path in entries[:max(len(entries) - self.max_entries, 0)]:
+            logger.debug(f'Evicting {path.name}')
+            _unlink(path)
+
+
+results_cache = ResultCache(
+    RESULTS_DIR,
+    max_entries=getattr(settings, 'RESULTS_CACHE_MAX_ENTRIES', 200),
+    ttl=getattr(settings, 'RESULTS_CACHE_TTL', 7 * 24 * 60 * 60),
+)
@@ -0,0 +1,49 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, close_old_connections, transaction
+
+from jobs.models import Job
+from jobs.runner import run_job
+
+
+class Command(BaseCommand):
+    help = 'Runs queued corpus analyses in a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds between checks for new jobs')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        # Jobs left running by a previous worker that died are picked up again.
+        requeued = 0
+        for job in Job.objects.filter(status=Job.StatusChoices.RUNNING.value):
+            job.status, job.progress = Job.StatusChoices.QUEUED.value, 0
+            try:
+                with transaction.atomic():
+                    job.save(update_fields=['status', 'progress'])
+                requeued += 1
+            except IntegrityError:  # an identical job is queued already, and runs instead
+                job.delete()
+        if requeued:
+            self.stdout.write(f"Requeued {requeued} interrupted jobs.")
+
+        self.stdout.write(f"Waiting for jobs with {workers} workers...")
+        # Spawned processes set up Django themselves instead of sharing this process's DB connections.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=django.setup) as pool:
+            running = set()
+            while True:
+                close_old_connections()
+                running = {f for f in running if not f.done()}
+                while len(running) < workers:
+                    job = Job.claim_next()
+                    if job is None:
+                        break
+                    self.stdout.write(f"Starting {job}")
+                    running.add(pool.submit(run_job, job.pk))
+                time.sleep(options['poll'])
@@ -0,0 +1,93 @@
+from enum import Enum
+import hashlib
+import json
+import uuid
+
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from core.fields import JSONTextField
+from .cache import results_cache
+
+
+class Job(models.Model):
+    """A corpus analysis queued by a view and run by the ``run_jobs`` worker."""
+    class StatusChoices(Enum):
+        QUEUED = 'queued'
+        RUNNING = 'running'
+        DONE = 'done'
+        FAILED = 'failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    kind = models.CharField(max_length=255)
+    params = JSONTextField(default=dict, blank=True)
+    key = models.CharField(max_length=40, blank=True, default="")  # identifies the kind and params, see job_key()
+    status = models.CharField(max_length=255, choices=[(s.value, s.value) for s in StatusChoices],
+                              default=StatusChoices.QUEUED.value)
+    progress = models.PositiveSmallIntegerField(default=0)  # percent
+    error = models.TextField(blank=True, default="")
+    result_key = models.CharField(max_length=255, blank=True, default="")
+    user = models.CharField(max_length=255, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+        ]
+        constraints = [
+            # At most one identical job waits in the queue, however many requests ask for it at once.
+            # Jobs queued before keys existed have none.
+            models.UniqueConstraint(fields=['key'], condition=models.Q(status='queued') & ~models.Q(key=''),
+                                    name='unique_queued_job'),
+        ]
+
+    def __str__(self):
+        return f'{self.kind} ({self.status}): {self.params}'
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in (self.StatusChoices.DONE.value, self.StatusChoices.FAILED.value)
+
+    def load_result(self):
+        """Return the result from the results cache, or None if it has been evicted."""
+        return results_cache.get(self.result_key) if self.result_key else None
+
+    @staticmethod
+    def job_key(kind: str, params: dict) -> str:
+        return hashlib.sha1(json.dumps([kind, params], sort_keys=True, default=str).encode()).hexdigest()
+
+    @classmethod
+    def enqueue(cls, kind: str, params: dict, user: str = "", reuse_running: bool = True) -> 'Job':
+        """
+        Queue an analysis, reusing an identical one that is still waiting or running.
+        :param reuse_running: False for jobs that must see changes made after a running one started
+        """
+        key = cls.job_key(kind, params)
+        pending = [cls.StatusChoices.QUEUED.value]
+        if reuse_running:
+            pending.append(cls.StatusChoices.RUNNING.value)
+        job = cls.objects.filter(key=key, status__in=pending).first()
+        if job is not None:
+            return job
+        try:
+            with transaction.atomic():
+                return cls.objects.create(kind=kind, params=params, key=key, user=user)
+        except IntegrityError:
+            # An identical request queued the same job in the meantime (see Meta.constraints).
+            return cls.enqueue(kind, params, user, reuse_running)
+
+    @classmethod
+    def claim_next(cls) -> 'Job':
+        """Mark the oldest queued job as running. Safe to call from several workers."""
+        with transaction.atomic():
+            job = cls.objects.select_for_update(skip_locked=True).filter(
+                status=cls.StatusChoices.QUEUED.value).first()
+            if job is None:
+                return None
+            job.status = cls.StatusChoices.RUNNING.value
+            job.started_at = timezone.now()
+            job.save(update_fields=['status', 'started_at'])
+        return job
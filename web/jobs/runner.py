@@ -0,0 +1,60 @@
+import logging
+import traceback
+from importlib import import_module
+from typing import Callable
+
+from django.utils import timezone
+
+from .cache import results_cache
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Job kind -> dotted path of the function that runs it. Each function takes the job params as keyword
+# arguments plus a ``progress`` callback, and returns a picklable result.
+TASKS = {
+    'freq': 'freqdist.utils.build_item_root_freq',
+    'coverage': 'freqdist.utils.calculate_coverage',
+    'kwic': 'kwic.utils.build_kwic',
+    'collocations': 'collocations.utils.get_collocates',
+    'corpus_frequencies': 'freqdist.utils.refresh_corpus_frequencies',
+}
+
+
+def _get_task(kind: str) -> Callable:
+    module, name = TASKS[kind].rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+def _progress_reporter(job_id) -> Callable[[float], None]:
+    """Return a callback that stores progress as a percentage, writing only when it changes."""
+    last = [0]
+
+    def report(fraction: float) -> None:
+        percent = min(int(fraction * 100), 99)
+        if percent > last[0]:
+            last[0] = percent
+            Job.objects.filter(pk=job_id).update(progress=percent)
+
+    return report
+
+
+def run_job(job_id) -> None:
+    """Run a claimed job. Called in a worker process of the ``run_jobs`` command."""
+    job = Job.objects.get(pk=job_id)
+    logger.info(f'Running job {job}')
+    try:
+        # The key is taken before running so that a result is never filed under a newer corpus version.
+        key = results_cache.make_key(job.kind, job.params)
+        result = _get_task(job.kind)(**job.params, progress=_progress_reporter(job.pk))
+        results_cache.set(key, result)
+        job.result_key = key
+    except Exception:
+        logger.exception(f'Job {job.pk} failed.')
+        job.status = Job.StatusChoices.FAILED.value
+        job.error = traceback.format_exc()
+    else:
+        job.status = Job.StatusChoices.DONE.value
+        job.progress = 100
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'progress', 'error', 'result_key', 'finished_at'])
@@ -0,0 +1,181 @@
+from pathlib import Path
+import tempfile
+from unittest import mock
+
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.cookie import CookieStorage
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.views.generic import View
+
+from . import runner
+from .cache import results_cache
+from .models import Job
+from .views import JobMixin
+
+TEST_TASKS = {
+    'double': 'jobs.tests.double',
+    'fail': 'jobs.tests.fail',
+}
+
+
+def double(n: int, progress=None) -> int:
+    progress(0.5)
+    return 2 * n
+
+
+def fail(progress=None):
+    raise ValueError('broken')
+
+
+class ResultsCacheTestCase(TestCase):
+    """Keep cached results in a temporary directory, and run the test tasks."""
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for patcher in (mock.patch.object(results_cache, 'directory', Path(directory.name)),
+                        mock.patch.dict(runner.TASKS, TEST_TASKS)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class EnqueueTests(TestCase):
+    def test_reuses_queued_job(self):
+        job = Job.enqueue('double', {'n': 1})
+        self.assertEqual(Job.enqueue('double', {'n': 1}), job)
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_different_params_make_another_job(self):
+        job = Job.enqueue('double', {'n': 1})
+        self.assertNotEqual(Job.enqueue('double', {'n': 2}), job)
+        self.assertNotEqual(Job.enqueue('fail', {'n': 1}), job)
+
+    def test_reuses_running_job_unless_told_not_to(self):
+        job = Job.enqueue('double', {'n': 1})
+        Job.objects.filter(pk=job.pk).update(status=Job.StatusChoices.RUNNING.value)
+        self.assertEqual(Job.enqueue('double', {'n': 1}), job)
+        queued = Job.enqueue('double', {'n': 1}, reuse_running=False)
+        self.assertNotEqual(queued, job)
+        self.assertEqual(queued.status, Job.StatusChoices.QUEUED.value)
+
+    def test_does_not_reuse_finished_job(self):
+        job = Job.enqueue('double', {'n': 1})
+        Job.objects.filter(pk=job.pk).update(status=Job.StatusChoices.DONE.value)
+        self.assertNotEqual(Job.enqueue('double', {'n': 1}), job)
+
+    def test_identical_job_is_queued_once(self):
+        job = Job.enqueue('double', {'n': 1})
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Job.objects.create(kind=job.kind, params=job.params, key=job.key)
+
+    def test_concurrent_request_reuses_the_job_it_lost_to(self):
+        job = Job.enqueue('double', {'n': 1})
+        # The other request's job is not there yet when this one looks, but is when it inserts.
+        with mock.patch('django.db.models.query.QuerySet.first', side_effect=[None, job]):
+            self.assertEqual(Job.enqueue('double', {'n': 1}), job)
+        self.assertEqual(Job.objects.count(), 1)
+
+
+class ClaimNextTests(TestCase):
+    def test_claims_oldest_queued_job(self):
+        first = Job.enqueue('double', {'n': 1})
+        Job.enqueue('double', {'n': 2})
+        job = Job.claim_next()
+        self.assertEqual(job, first)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.StatusChoices.RUNNING.value)
+        self.assertIsNotNone(job.started_at)
+
+    def test_skips_running_jobs(self):
+        Job.enqueue('double', {'n': 1})
+        second = Job.enqueue('double', {'n': 2})
+        Job.claim_next()
+        self.assertEqual(Job.claim_next(), second)
+        self.assertIsNone(Job.claim_next())
+
+
+class RunJobTests(ResultsCacheTestCase):
+    def test_success_stores_result(self):
+        job = Job.enqueue('double', {'n': 21})
+        runner.run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.StatusChoices.DONE.value)
+        self.assertEqual(job.progress, 100)
+        self.assertIsNotNone(job.finished_at)
+        self.assertEqual(job.result_key, results_cache.make_key('double', {'n': 21}))
+        self.assertEqual(job.load_result(), 42)
+
+    def test_failure_records_error(self):
+        job = Job.enqueue('fail', {})
+        runner.run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.StatusChoices.FAILED.value)
+        self.assertIn('ValueError: broken', job.error)
+        self.assertEqual(job.result_key, "")
+        self.assertIsNone(job.load_result())
+
+
+class DoubleView(JobMixin, View):
+    job_kind = 'double'
+
+    def get_job_params(self):
+        n = self.request.GET.get('n')
+        return {'n': int(n)} if n else None
+
+    def render_job_result(self, result):
+        return HttpResponse(f'{result} {self.result_key}')
+
+
+@override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class JobMixinTests(ResultsCacheTestCase):
+    def get(self, params: dict):
+        request = RequestFactory().get('/double/', params)
+        request.user = AnonymousUser()
+        request._messages = CookieStorage(request)
+        return DoubleView.as_view()(request)
+
+    def test_nothing_to_run(self):
+        self.assertEqual(self.get({}).content, b'None None')
+        self.assertFalse(Job.objects.exists())
+
+    def test_cache_miss_queues_job(self):
+        response = self.get({'n': 3})
+        job = Job.objects.get()
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(f'job={job.pk}', response.url)
+        self.assertEqual(job.params, {'n': 3})
+
+    def test_cache_hit_renders_without_job(self):
+        key = results_cache.make_key('double', {'n': 3})
+        results_cache.set(key, 6)
+        self.assertEqual(self.get({'n': 3}).content, f'6 {key}'.encode())
+        self.assertFalse(Job.objects.exists())
+
+    def test_pending_job(self):
+        job = Job.enqueue('double', {'n': 3})
+        response = self.get({'n': 3, 'job': job.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'Working...', response.content)
+
+    def test_done_job_renders_result(self):
+        job = Job.enqueue('double', {'n': 3})
+        runner.run_job(job.pk)
+        job.refresh_from_db()
+        self.assertEqual(self.get({'n': 3, 'job': job.pk}).content, f'6 {job.result_key}'.encode())
+
+    def test_done_job_with_evicted_result_is_queued_again(self):
+        job = Job.enqueue('double', {'n': 3})
+        runner.run_job(job.pk)
+        for path in results_cache.directory.glob('*.pkl'):
+            path.unlink()
+        response = self.get({'n': 3, 'job': job.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Job.objects.filter(status=Job.StatusChoices.QUEUED.value).count(), 1)
+
+    def test_failed_job_redirects_to_form(self):
+        job = Job.enqueue('double', {'n': 3})
+        Job.objects.filter(pk=job.pk).update(status=Job.StatusChoices.FAILED.value)
+        response = self.get({'n': 3, 'job': job.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '/double/')
@@ -0,0 +1,79 @@
+import logging
+from typing import Optional
+
+from django.contrib import messages
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
+from django.views.generic import View
+
+from .cache import results_cache
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatusView(LoginRequiredMixin, View):
+    def get(self, request, *args, **kwargs):
+        job = get_object_or_404(Job, pk=kwargs.get('pk'))
+        data = {
+            'status': job.status,
+            'progress': job.progress,
+            'is_finished': job.is_finished,
+        }
+        return JsonResponse(data)
+
+
+def enqueue_and_redirect(request, kind: str, params: dict):
+    """Queue a job and send the user back to the same page, which then polls it."""
+    job = Job.enqueue(kind, params, user=request.user.get_username())
+    query = request.GET.copy()
+    query['job'] = str(job.pk)
+    return redirect(f'{request.path}?{query.urlencode()}')
+
+
+def render_pending(request, job: Job):
+    return render(request, 'jobs/pending.html', context={'job': job})
+
+
+class JobMixin:
+    """
+    Run a view's analysis in the job queue so that the request returns immediately.
+    Subclasses set ``job_kind`` and implement ``get_job_params()`` and ``render_job_result()``.
+    Results are shared through the results cache, so identical queries are only computed once.
+    """
+    job_kind = None
+    result_key = None  # cache key of the rendered result, used by exports
+
+    def get_job_params(self) -> Optional[dict]:
+        """Return the keyword arguments of the job, or None if there is nothing to run."""
+        raise NotImplementedError
+
+    def render_job_result(self, result):
+        """Render the page with the job's result, or the empty form if ``result`` is None."""
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        job_id = request.GET.get('job')
+        if job_id:
+            job = get_object_or_404(Job, pk=job_id)
+            if job.status == Job.StatusChoices.DONE.value:
+                result = job.load_result()
+                if result is None:  # evicted from the cache since
+                    return enqueue_and_redirect(request, job.kind, job.params)
+                self.result_key = job.result_key
+                return self.render_job_result(result)
+            if job.status == Job.StatusChoices.FAILED.value:
+                messages.error(request, 'Something happened. Please try again.')
+                return redirect(request.path)
+            return render_pending(request, job)
+
+        params = self.get_job_params()
+        if params is None:
+            return self.render_job_result(None)
+        key = results_cache.make_key(self.job_kind, params)
+        result = results_cache.get(key)
+        if result is not None:
+            self.result_key = key
+            return self.render_job_result(result)
+        return enqueue_and_redirect(request, self.job_kind, params)
@@ -0,0 +1,165 @@
+"""
+Lazily rendered concordances.
+
+A KWIC result keeps each hit as the text it occurs in and its offset there, plus the ranks of the words
+around it as sort keys. Lines are only rendered into strings for the page being shown, so the result and
+the page stay small however many hits a query has.
+"""
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+from nltk.text import ConcordanceLine
+
+from . import index as corpus_index
+from .index import Vocabulary
+
+SIDES = ('left', 'right')
+SORT_WINDOW = 5  # widest sort window offered by the form
+RENDER_BATCH = 1000  # lines rendered at a time when iterating over all of them
+
+# Rank of the lower-cased form of every token, by vocabulary size. The vocabulary only grows, so a size
+# identifies its contents.
+_RANKS: Dict[int, np.ndarray] = {}
+
+
+def lower_ranks(vocab: Vocabulary) -> np.ndarray:
+    """Rank of each token's lower-cased form, so that comparing ranks compares words case-insensitively."""
+    if len(vocab) not in _RANKS:
+        lowered = [t.lower() for t in vocab.types]
+        ranks = np.empty(len(lowered), dtype=np.int32)
+        rank, previous = -1, None
+        for i in sorted(range(len(lowered)), key=lowered.__getitem__):
+            if lowered[i] != previous:
+                rank, previous = rank + 1, lowered[i]
+            ranks[i] = rank
+        _RANKS.clear()
+        _RANKS[len(vocab)] = ranks
+    return _RANKS[len(vocab)]
+
+
+def context_keys(ids: np.ndarray, offsets: np.ndarray, query_len: int, width: int,
+                 ranks: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Ranks of the ``SORT_WINDOW`` words on either side of each hit, nearest first, or -1 where the context
+    shown (``width`` words, up to the edge of the text) has no word.
+    """
+    distance = np.arange(SORT_WINDOW)
+    left = offsets[:, None] - 1 - distance
+    right = offsets[:, None] + query_len + distance
+    left_keys = np.where(left >= 0, ranks[ids[np.maximum(left, 0)]], -1)
+    right_keys = np.where(right < len(ids), ranks[ids[np.minimum(right, len(ids) - 1)]], -1)
+    left_keys[:, width:] = -1
+    right_keys[:, width:] = -1
+    return left_keys.astype(np.int32), right_keys.astype(np.int32)
+
+
+def _render_lines(ids: np.ndarray, vocab: Vocabulary, query_len: int, offsets: List[int],
+                  width: int) -> List[ConcordanceLine]:
+    conc_lines = []
+    for offset in offsets:
+        left = vocab.decode(ids[max(offset - width, 0):offset])
+        center = vocab.decode(ids[offset:(offset + query_len)])
+        right = vocab.decode(ids[(offset + query_len):(offset + query_len + width)])
+        left_print = " ".join(left)
+        right_print = " ".join(right)
+        center_print = " ".join(center)
+        line_print = " ".join([left_print, center_print, right_print])
+        conc_line = ConcordanceLine(
+            left=left,
+            query=center_print,
+            right=right,
+            offset=offset,
+            left_print=left_print,
+            right_print=right_print,
+            line=line_print
+        )
+        conc_lines.append(conc_line)
+
+    return conc_lines
+
+
+@dataclass
+class Concordance:
+    """
+    The hits of a KWIC query, in corpus order.
+    :param total: Number of hits in the corpus, of which the concordance keeps the first or a random sample
+    :param doc_names: Texts searched, as named in the index
+    :param doc_lengths: Number of tokens of each text when searched, to notice texts indexed again since
+    :param docs: Index into ``doc_names`` of each hit
+    :param offsets: Offset of each hit in its text
+    :param left_keys: See context_keys()
+    :param right_keys: See context_keys()
+    """
+    query_len: int
+    width: int
+    total: int
+    doc_names: List[str]
+    doc_lengths: List[int]
+    docs: np.ndarray
+    offsets: np.ndarray
+    left_keys: np.ndarray
+    right_keys: np.ndarray
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def is_current(self) -> bool:
+        """Whether the texts are still indexed as they were searched, so that offsets still point to the hits."""
+        for name, length in zip(self.doc_names, self.doc_lengths):
+            doc = corpus_index.read_doc(name)
+            if doc is None or len(doc.ids) != length:
+                return False
+        return True
+
+    def order(self, side: str = 'left', window: int = 2) -> np.ndarray:
+        """
+        Hits sorted by the lower-cased words of one side, like comparing ``line.left[-window:]`` or
+        ``line.right[:window]`` of the rendered lines. The sort is stable, so ties stay in corpus order.
+        """
+        window = max(1, min(window, SORT_WINDOW, self.width))
+        if side == 'right':
+            columns = [self.right_keys[:, c] for c in range(window)]
+        else:
+            # The left words are compared from the farthest one shown, so fewer words near the start of a
+            # text shift to the front, and the missing ones sort first at the end.
+            shown = np.minimum(self.offsets, window)
+            columns = []
+            for c in range(window):
+                distance = np.maximum(shown - 1 - c, 0)
+                columns.append(np.where(c < shown, self.left_keys[np.arange(len(self)), distance], -1))
+        return np.lexsort(columns[::-1]) if len(self) else np.arange(0)
+
+    def lines(self, hits: np.ndarray) -> List[ConcordanceLine]:
+        """Render the given hits, in the given order."""
+        vocab = corpus_index.load_vocab()
+        rendered = {}
+        for doc_index in np.unique(self.docs[hits]).tolist():
+            doc = corpus_index.read_doc(self.doc_names[doc_index])
+            in_doc = hits[self.docs[hits] == doc_index]
+            for hit, line in zip(in_doc.tolist(), _render_lines(doc.ids, vocab, self.query_len,
+                                                                  self.offsets[in_doc].tolist(), self.width)):
+                rendered[hit] = line
+        return [rendered[hit] for hit in hits.tolist()]
+
+    def sorted(self, side: str = 'left', window: int = 2) -> 'SortedConcordance':
+        return SortedConcordance(self, self.order(side, window))
+
+
+class SortedConcordance:
+    """A sequence of concordance lines in a given order, rendered when sliced. Suits Django's Paginator."""
+    def __init__(self, concordance: Concordance, order: np.ndarray):
+        self.concordance = concordance
+        self._order = order
+
+    def __len__(self):
+        return len(self._order)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.concordance.lines(self._order[index])
+        return self.concordance.lines(self._order[[index]])[0]
+
+    def __iter__(self) -> Iterator[ConcordanceLine]:
+        for start in range(0, len(self), RENDER_BATCH):
+            yield from self[start:start + RENDER_BATCH]
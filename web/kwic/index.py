@@ -0,0 +1,349 @@
+"""
+Token-id corpus shared by the frequency, KWIC and collocation tools.
+
+Every text is tokenized once into a NumPy int32 array of ids into a single, append-only vocabulary and saved
+as ``.npy``, which is memory-mapped on load. Frequencies, n-gram counts and phrase lookups then run as
+vectorized operations over these arrays instead of over Python lists of strings. Documents hold the tokens of
+the texts only; spelling variants are looked up when querying, see :mod:`kwic.query`.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass
+import fcntl
+import logging
+import os
+from pathlib import Path
+import pickle
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db.models import Count, Max
+import numpy as np
+
+from core.models import Example
+from freqdist.models import TextFile
+from .tokenizer import TOKENIZER_VERSION, TextCounter, split_sentences, split_words, tokenize
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = Path(__file__).parent / 'static/kwic/index'
+if not INDEX_DIR.exists():
+    INDEX_DIR.mkdir(parents=True)
+VOCAB_PATH = INDEX_DIR / 'vocab.pkl'
+VOCAB_LOCK_PATH = INDEX_DIR / 'vocab.lock'
+
+EXAMPLES_DOC = 'examples'
+ID_DTYPE = np.int32
+
+# Loaded documents and the vocabulary are kept per worker and only re-read when their file changes.
+_DOC_CACHE: Dict[str, Tuple[int, 'IndexedDoc']] = {}
+_STATS_CACHE: Dict[str, Tuple[int, 'TermStats']] = {}
+_VOCAB_CACHE: Dict[str, Tuple[int, 'Vocabulary']] = {}
+
+
+class Vocabulary:
+    """Token <-> id table. Tokens are only ever appended, so ids stored in documents stay valid."""
+    def __init__(self, types: Iterable[str] = ()):
+        self.types: List[str] = list(types)
+        self.ids: Dict[str, int] = {t: i for i, t in enumerate(self.types)}
+
+    def __len__(self):
+        return len(self.types)
+
+    def lookup(self, tokens: Iterable[str]) -> Optional[List[int]]:
+        """Ids of the tokens, or None if any of them never occurs in the corpus."""
+        ids = [self.ids.get(t) for t in tokens]
+        return None if None in ids else ids
+
+    def add(self, tokens: List[str]) -> np.ndarray:
+        """Encode the tokens, appending the ones not seen before."""
+        for token in set(tokens).difference(self.ids):
+            self.ids[token] = len(self.types)
+            self.types.append(token)
+        return np.fromiter((self.ids[t] for t in tokens), dtype=ID_DTYPE, count=len(tokens))
+
+    def decode(self, ids: Iterable[int]) -> List[str]:
+        return [self.types[i] for i in ids]
+
+
+@dataclass
+class IndexedDoc:
+    """
+    Token ids of one text. ``ids`` is memory-mapped from the document's ``.npy`` file.
+    :param word_num: Number of words of the text, counted when it was tokenized
+    :param sent_num: Number of sentences of the text, counted when it was tokenized
+    """
+    name: str
+    ids: np.ndarray
+    signature: Optional[tuple] = None
+    word_num: int = 0
+    sent_num: int = 0
+
+
+@dataclass
+class TermStats:
+    """How often each token id occurs in a document. ``types`` is sorted."""
+    types: np.ndarray
+    counts: np.ndarray
+
+    def count(self, ids: np.ndarray) -> np.ndarray:
+        if not len(self.types):
+            return np.zeros(len(ids), dtype=np.int64)
+        slots = np.minimum(np.searchsorted(self.types, ids), len(self.types) - 1)
+        return np.where(self.types[slots] == ids, self.counts[slots], 0)
+
+
+@contextmanager
+def _locked_vocab():
+    with VOCAB_LOCK_PATH.open('w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _write_atomic(path: Path, write) -> None:
+    """Write atomically so that other workers never read a half-written file."""
+    fd, tmp = tempfile.mkstemp(dir=INDEX_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def load_vocab() -> Vocabulary:
+    try:
+        mtime = VOCAB_PATH.stat().st_mtime_ns
+    except FileNotFoundError:
+        return Vocabulary()
+    cached = _VOCAB_CACHE.get('vocab')
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with VOCAB_PATH.open('rb') as f:
+        vocab = Vocabulary(pickle.load(f))
+    _VOCAB_CACHE['vocab'] = (mtime, vocab)
+    return vocab
+
+
+def encode(tokens: List[str]) -> np.ndarray:
+    """Encode tokens with the shared vocabulary, persisting the tokens it did not know yet."""
+    vocab = load_vocab()
+    ids = vocab.lookup(tokens)
+    if ids is not None:
+        return np.array(ids, dtype=ID_DTYPE)
+    with _locked_vocab():
+        _VOCAB_CACHE.clear()  # another worker may have appended since
+        vocab = load_vocab()
+        size = len(vocab)
+        ids = vocab.add(tokens)
+        if len(vocab) > size:
+            _write_atomic(VOCAB_PATH, lambda f: pickle.dump(vocab.types, f, protocol=pickle.HIGHEST_PROTOCOL))
+            _VOCAB_CACHE.clear()
+    return ids
+
+
+def _encode_chunks(token_chunks: Iterable[List[str]]) -> np.ndarray:
+    """
+    Encode a text tokenized in chunks, persisting the tokens new to the vocabulary in a single write at the end
+    rather than once per chunk. Until then, new tokens get negative ids counting down from -1.
+    """
+    vocab = load_vocab()
+    new_types: Dict[str, int] = {}
+
+    def provisional_id(token: str) -> int:
+        i = vocab.ids.get(token)
+        return i if i is not None else -1 - new_types.setdefault(token, len(new_types))
+
+    chunks = [np.fromiter(map(provisional_id, tokens), dtype=ID_DTYPE, count=len(tokens)) for tokens in token_chunks]
+    ids = np.concatenate(chunks) if chunks else np.empty(0, dtype=ID_DTYPE)
+    if new_types:
+        new_ids = encode(list(new_types))
+        provisional = ids < 0
+        ids[provisional] = new_ids[-1 - ids[provisional]]
+    return ids
+
+
+def _doc_prefix(text_file: TextFile) -> str:
+    if not text_file.content_hash:  # uploaded before texts were hashed
+        text_file.hash_content()
+        text_file.save(update_fields=['content_hash'])
+    return f'text_{text_file.content_hash}_v'
+
+
+def _doc_name(text_file: TextFile) -> str:
+    """Tokens are stored by content and tokenizer version, so a changed tokenizer never reads stale tokens."""
+    return f'{_doc_prefix(text_file)}{TOKENIZER_VERSION}'
+
+
+def _doc_path(name: str) -> Path:
+    return INDEX_DIR / f'{name}.npy'
+
+
+def _meta_path(name: str) -> Path:
+    return INDEX_DIR / f'{name}.meta'
+
+
+def _stats_path(name: str) -> Path:
+    return INDEX_DIR / f'{name}.tf.npy'
+
+
+def _count_terms(ids: np.ndarray) -> np.ndarray:
+    return np.stack(np.unique(ids, return_counts=True)).astype(np.int64)
+
+
+def _write_doc(doc: IndexedDoc) -> None:
+    meta = {'signature': doc.signature, 'word_num': doc.word_num, 'sent_num': doc.sent_num}
+    _write_atomic(_meta_path(doc.name), lambda f: pickle.dump(meta, f))
+    _write_atomic(_doc_path(doc.name), lambda f: np.save(f, doc.ids))
+    _write_atomic(_stats_path(doc.name), lambda f: np.save(f, _count_terms(doc.ids)))
+
+
+def read_doc(name: str) -> Optional[IndexedDoc]:
+    """A stored document by name, as it is on disk, or None if it has not been indexed. Never indexes it."""
+    path = _doc_path(name)
+    try:
+        mtime = path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _DOC_CACHE.get(name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    meta = {}
+    if _meta_path(name).exists():
+        with _meta_path(name).open('rb') as f:
+            meta = pickle.load(f)
+    doc = IndexedDoc(name=name, ids=np.load(path, mmap_mode='r'), **meta)
+    _DOC_CACHE[name] = (mtime, doc)
+    return doc
+
+
+def term_stats(doc: IndexedDoc) -> TermStats:
+    """Term frequencies of a document, saved next to it when it is indexed so that counts need no scan."""
+    mtime = _doc_path(doc.name).stat().st_mtime_ns
+    cached = _STATS_CACHE.get(doc.name)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    path = _stats_path(doc.name)
+    if path.exists() and path.stat().st_mtime_ns >= mtime:
+        table = np.load(path)
+    else:
+        # Documents indexed before the statistics existed, or a document being indexed again right now.
+        table = _count_terms(doc.ids)
+    stats = TermStats(types=table[0], counts=table[1])
+    _STATS_CACHE[doc.name] = (mtime, stats)
+    return stats
+
+
+def _remove_doc_files(prefix: str, keep: str = None) -> None:
+    """Remove the files of the documents whose name starts with ``prefix``, except document ``keep``."""
+    for path in INDEX_DIR.glob(f'{prefix}*'):
+        name = path.name.split('.', 1)[0]
+        if name != keep:
+            _DOC_CACHE.pop(name, None)
+            _STATS_CACHE.pop(name, None)
+            path.unlink()
+
+
+def index_text_file(text_file: TextFile) -> IndexedDoc:
+    """
+    Tokenize an uploaded text once and store its token ids on disk, with its numbers of words and sentences.
+    The text is streamed in chunks.
+    """
+    counter = TextCounter()
+
+    def token_chunks():
+        for chunk in text_file.iter_text():
+            counter.feed(chunk)
+            yield tokenize(chunk)
+
+    ids = _encode_chunks(token_chunks())
+    doc = IndexedDoc(name=_doc_name(text_file), ids=ids, word_num=counter.word_num, sent_num=counter.sent_num)
+    _write_doc(doc)
+    _remove_doc_files(_doc_prefix(text_file), keep=doc.name)  # tokens of earlier tokenizer versions
+    logger.debug(f'Indexed {text_file.name}: {len(doc.ids)} tokens.')
+    return doc
+
+
+def remove_text_file(text_file: TextFile) -> None:
+    """Remove the tokens of a text being deleted, unless another upload has the same content."""
+    if not text_file.content_hash:
+        return  # never indexed by content
+    if TextFile.objects.filter(content_hash=text_file.content_hash).exclude(pk=text_file.pk).exists():
+        return
+    _remove_doc_files(_doc_prefix(text_file))
+
+
+def clear_index() -> None:
+    """Remove all documents. The vocabulary is kept, as ids in it never change meaning."""
+    _DOC_CACHE.clear()
+    _STATS_CACHE.clear()
+    for pattern in ('*.npy', '*.meta', '*.pkl'):
+        for path in INDEX_DIR.glob(pattern):
+            if path != VOCAB_PATH:
+                path.unlink()
+
+
+def rebuild_index() -> None:
+    clear_index()
+    for text_file in TextFile.objects.all():
+        index_text_file(text_file)
+
+
+def _examples_signature() -> tuple:
+    stats = Example.objects.aggregate(count=Count('id'), modified=Max('modified_date'))
+    return stats['count'], stats['modified'], TOKENIZER_VERSION
+
+
+def load_examples_doc() -> IndexedDoc:
+    """Examples are edited through the dictionary, so their document is rebuilt whenever they change."""
+    signature = _examples_signature()
+    doc = read_doc(EXAMPLES_DOC)
+    if doc is None or doc.signature != signature:
+        sentences = list(Example.objects.all().values_list('sentence', flat=True))
+        # Each example is counted on its own, so that one without a full stop is still a sentence.
+        doc = IndexedDoc(
+            name=EXAMPLES_DOC,
+            ids=encode(tokenize(" ".join(sentences))),
+            signature=signature,
+            word_num=sum(len(split_words(s)) for s in sentences),
+            sent_num=sum(len(split_sentences(s)) for s in sentences),
+        )
+        _write_doc(doc)
+    return doc
+
+
+def load_doc(text_file: TextFile) -> IndexedDoc:
+    doc = read_doc(_doc_name(text_file))
+    if doc is None:
+        # Texts uploaded before the index existed, or tokenized by an earlier tokenizer, are indexed on first use.
+        doc = index_text_file(text_file)
+    return doc
+
+
+def load_docs(include_examples: bool) -> List[IndexedDoc]:
+    text_files = TextFile.objects.all().only('id', 'name', 'file', 'encoding', 'content_hash')
+    docs = [load_doc(text_file) for text_file in text_files]
+    if include_examples:
+        docs.append(load_examples_doc())
+    return docs
+
+
+def _in_slot(ids: np.ndarray, slot) -> np.ndarray:
+    """Whether each id is the token id ``slot``, or one of the ids in the array ``slot``."""
+    if np.ndim(slot) and len(slot) == 1:
+        slot = slot[0]
+    return np.isin(ids, slot) if np.ndim(slot) else ids == slot
+
+
+def find_offsets(ids: np.ndarray, query_ids: list) -> np.ndarray:
+    """
+    Return the offsets at which the token id sequence ``query_ids`` starts in ``ids``. Each entry is a token
+    id, or an array of the ids allowed at that position.
+    """
+    if not query_ids or len(ids) < len(query_ids):
+        return np.empty(0, dtype=np.int64)
+    offsets = np.flatnonzero(_in_slot(ids[:len(ids) - len(query_ids) + 1], query_ids[0]))
+    for i, q in enumerate(query_ids[1:], 1):
+        offsets = offsets[_in_slot(ids[offsets + i], q)]
+        if not len(offsets):
+            break
+    return offsets
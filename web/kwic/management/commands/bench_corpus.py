@@ -0,0 +1,105 @@
+from collections import defaultdict
+import random
+import string
+import time
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand
+import numpy as np
+
+from collocations.utils import count_ngrams, score_ngrams, MEASURES_FINDERS_DICT, NGRAM_SIZES
+from freqdist.utils import count_text, count_tokens
+from kwic.index import find_offsets, Vocabulary
+from kwic.tokenizer import tokenize
+
+
+def _random_word(rng: random.Random) -> str:
+    return "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(1, 8)))
+
+
+def _postings_offsets(postings: Dict[str, List[int]], query_list: List[str]) -> List[int]:
+    """The lookup build_kwic() used before token ids: intersect the offsets of each query word."""
+    offsets = set(postings.get(query_list[0], []))
+    for i, q in enumerate(query_list[1:], 1):
+        offsets.intersection_update(x - i for x in postings.get(q, []))
+    return sorted(offsets)
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks the token-id corpus against the string-based counting, KWIC lookup and NLTK finders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=500000, help='Words in the synthetic corpus')
+        parser.add_argument('--types', type=int, default=20000, help='Distinct words in the synthetic corpus')
+        parser.add_argument('--window-size', type=int, default=0, help='Collocation window; the n-gram size if 0')
+        parser.add_argument('--freq-filter', type=int, default=3)
+        parser.add_argument('--texts', type=int, default=5, help='Texts the corpus is split into')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def timed(self, label: str, f, *args):
+        start = time.perf_counter()
+        result = f(*args)
+        secs = time.perf_counter() - start
+        self.stdout.write(f"  {label}: {secs * 1000:.1f}ms")
+        return result, secs
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        words = [_random_word(rng) for _ in range(options['types'])]
+        # Zipf-like frequencies, with some punctuation and numbers in between.
+        weights = [1 / rank for rank in range(1, len(words) + 1)]
+        corpus = rng.choices(words + [',', '.', '2020', "o'"], weights + [0.5, 0.5, 0.01, 0.05], k=options['tokens'])
+        text = " ".join(corpus)
+
+        tokens = tokenize(text)
+        vocab = Vocabulary()
+        ids, _ = self.timed('Tokenizing and encoding once', vocab.add, tokens)
+        self.stdout.write(f"{len(tokens)} tokens, {len(vocab)} types")
+
+        self.stdout.write("Word frequencies")
+        expected, before = self.timed('Counter over the text', lambda: count_text(text)[0])
+        actual, after = self.timed('bincount over token ids', count_tokens, ids, vocab.types)
+        assert expected == actual, 'Token-id counts disagree with the text counts'
+        self.stdout.write(f"  Speed-up: {before / after:.1f}x")
+
+        self.stdout.write("KWIC lookup of a two-word phrase")
+        query_list = tokens[len(tokens) // 2:len(tokens) // 2 + 2]
+
+        def postings_lookup():
+            postings = defaultdict(list)
+            for offset, token in enumerate(tokens):
+                postings[token].append(offset)
+            return _postings_offsets(postings, query_list)
+
+        expected, before = self.timed('Postings built from the token list', postings_lookup)
+        actual, after = self.timed('Vectorized scan of token ids', find_offsets, ids, vocab.lookup(query_list))
+        assert expected == actual.tolist(), 'Vectorized offsets disagree with the postings'
+        self.stdout.write(f"  Speed-up: {before / after:.1f}x")
+
+        texts = np.array_split(ids, options['texts'])
+        query = tokens[len(tokens) // 3]
+        for ngram in ('bigram', 'trigram', 'quadgram'):
+            self.stdout.write(f"{ngram.capitalize()} collocations of {query!r}")
+            measures, finder_class = MEASURES_FINDERS_DICT[ngram]
+            n = NGRAM_SIZES[ngram]
+            window_size = options['window_size'] or n
+            measure = measures.likelihood_ratio
+
+            def nltk_scores():
+                """What get_collocates() did before the counts were persisted, minus its query/limit bug."""
+                finder = finder_class.from_words(tokens, window_size=window_size)
+                finder.apply_freq_filter(options['freq_filter'])
+                return finder.score_ngrams(measure)
+
+            def query_scores(selected):
+                selected = selected[counts.ngram_counts[selected] >= options['freq_filter']]
+                return [(ngram, score) for ngram, score, _ in score_ngrams(counts, measure, selected, vocab.types)]
+
+            expected, before = self.timed('NLTK from_words() and scoring', nltk_scores)
+            counts, build = self.timed('Counting over token ids (once per corpus)', count_ngrams, texts, n,
+                                       window_size, len(vocab))
+            assert expected == query_scores(np.arange(len(counts.ngrams))), 'Scores disagree with NLTK'
+            query_ids = vocab.lookup([query])
+            actual, after = self.timed('Scoring the n-grams of the query', query_scores, counts.containing(query_ids))
+            assert [r for r in expected if query in r[0]] == actual, 'Query scores disagree with NLTK'
+            self.stdout.write(f"  Speed-up: {before / (build + after):.1f}x uncached, {before / after:.0f}x cached")
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from kwic.index import rebuild_index
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the token-id index of all uploaded texts used by KWIC, collocations and frequencies'
+
+    def handle(self, *args, **options):
+        self.stdout.write("Rebuilding corpus index...")
+        rebuild_index()
+        self.stdout.write("Done!")
@@ -0,0 +1,126 @@
+"""
+Concordance queries. Each word of a query is resolved against the vocabulary into the token ids it matches:
+
+- ``word`` matches that token and its spelling variants: the headword it is a variant of, and the other
+  variants of that headword
+- ``m*an``, ``*un``, ``ka?`` are wildcards: ``*`` matches any run of characters, ``?`` any single one
+- ``/regex/`` matches the tokens the regular expression matches in full
+
+Patterns are matched against the distinct tokens instead of the corpus, and only the tokens sharing a
+wildcard's literal prefix or suffix are tested at all.
+"""
+from bisect import bisect_left
+from collections import defaultdict
+import re
+from typing import Dict, FrozenSet, List, Optional, Pattern, Tuple
+
+from django.db.models import Count, Max, Q
+import numpy as np
+
+from core.models import Headword
+from .index import Vocabulary, ID_DTYPE
+
+WILDCARD_RE = re.compile(r'([*?])')
+
+
+def is_regex(word: str) -> bool:
+    return len(word) > 2 and word.startswith('/') and word.endswith('/')
+
+
+def is_wildcard(word: str) -> bool:
+    return WILDCARD_RE.search(word) is not None
+
+
+def compile_word(word: str) -> Optional[Pattern]:
+    """The pattern of a query word, or None for a plain word. Raises ``re.error`` for invalid regexes."""
+    if is_regex(word):
+        return re.compile(word[1:-1])
+    if is_wildcard(word):
+        parts = WILDCARD_RE.split(word)
+        return re.compile("".join({'*': '.*', '?': '.'}.get(p, re.escape(p)) for p in parts), re.DOTALL)
+    return None
+
+
+class SortedVocabulary:
+    """The tokens of a vocabulary sorted forwards and backwards, to find those with a given prefix or suffix."""
+    def __init__(self, vocab: Vocabulary):
+        self.types = vocab.types
+        self.forward = sorted(range(len(vocab)), key=vocab.types.__getitem__)
+        self.forward_keys = [vocab.types[i] for i in self.forward]
+        self.backward = sorted(range(len(vocab)), key=lambda i: vocab.types[i][::-1])
+        self.backward_keys = [vocab.types[i][::-1] for i in self.backward]
+
+    @staticmethod
+    def _range(keys: List[str], ids: List[int], prefix: str) -> List[int]:
+        # Every string starting with ``prefix`` sorts before the prefix with its last character incremented.
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return ids[bisect_left(keys, prefix):bisect_left(keys, end)]
+
+    def with_prefix(self, prefix: str) -> List[int]:
+        return self._range(self.forward_keys, self.forward, prefix)
+
+    def with_suffix(self, suffix: str) -> List[int]:
+        return self._range(self.backward_keys, self.backward, suffix[::-1])
+
+
+# By vocabulary size, as the vocabulary only grows.
+_SORTED: Dict[int, SortedVocabulary] = {}
+# Spelling variants by word, with the signature of the headwords they were read from.
+_VARIANTS: Dict[str, Tuple[tuple, Dict[str, FrozenSet[str]]]] = {}
+
+
+def sorted_vocabulary(vocab: Vocabulary) -> SortedVocabulary:
+    if len(vocab) not in _SORTED:
+        _SORTED.clear()
+        _SORTED[len(vocab)] = SortedVocabulary(vocab)
+    return _SORTED[len(vocab)]
+
+
+def _headwords_signature() -> tuple:
+    stats = Headword.objects.aggregate(count=Count('id'), modified=Max('modified_date'))
+    return stats['count'], stats['modified']
+
+
+def variant_map() -> Dict[str, FrozenSet[str]]:
+    """
+    The spellings of every headword that has variants and of each of its variants, the word itself included.
+    Read from the dictionary again only when headwords have changed.
+    """
+    signature = _headwords_signature()
+    cached = _VARIANTS.get('variants')
+    if cached and cached[0] == signature:
+        return cached[1]
+    spellings = defaultdict(set)
+    for headword, variants in Headword.objects.filter(~Q(variant=[''])).values_list('headword', 'variant'):
+        group = {headword, *filter(None, variants)}
+        for word in group:
+            spellings[word] |= group
+    variants = {word: frozenset(group) for word, group in spellings.items() if len(group) > 1}
+    _VARIANTS['variants'] = (signature, variants)
+    return variants
+
+
+def match_word(word: str, vocab: Vocabulary, variants: Dict[str, FrozenSet[str]] = None) -> np.ndarray:
+    """Ids of the tokens a query word matches, sorted. Only plain words are expanded with ``variants``."""
+    pattern = compile_word(word)
+    if pattern is None:
+        spellings = (variants or {}).get(word, (word,))
+        return np.array(sorted(vocab.ids[w] for w in spellings if w in vocab.ids), dtype=ID_DTYPE)
+    candidates = range(len(vocab))
+    if not is_regex(word):
+        parts = WILDCARD_RE.split(word)
+        prefix, suffix = parts[0], parts[-1]
+        if prefix or suffix:
+            index = sorted_vocabulary(vocab)
+            candidates = index.with_prefix(prefix) if len(prefix) >= len(suffix) else index.with_suffix(suffix)
+    ids = [i for i in candidates if pattern.fullmatch(vocab.types[i])]
+    return np.array(sorted(ids), dtype=ID_DTYPE)
+
+
+def resolve_query(query_list: List[str], vocab: Vocabulary,
+                  variants: Dict[str, FrozenSet[str]] = None) -> Optional[List[np.ndarray]]:
+    """The token ids each word of the query matches, or None if some word matches none."""
+    slots = [match_word(word, vocab, variants) for word in query_list]
+    if not slots or not all(len(slot) for slot in slots):
+        return None
+    return slots
@@ -0,0 +1,82 @@
+"""
+Tokenization shared by the frequency, KWIC and collocation tools.
+
+A text is tokenized once, when it is indexed (see :mod:`kwic.index`), and its words and sentences are counted in
+the same pass. Every tool then works on the stored tokens. ``TOKENIZER_VERSION`` is part of the name of every
+stored token file, so bump it whenever a change here would split or count any text differently: texts are then
+tokenized again on first use.
+"""
+import re
+import string
+from typing import Iterable, Iterator, List, Tuple
+
+from zhon import hanzi
+
+TOKENIZER_VERSION = 1
+
+SENT_BOUNDARY = '.。!！?？;；'
+SENT_BOUNDARY_RE = re.compile(rf'[{SENT_BOUNDARY}]')
+
+PUNCTUATION = hanzi.punctuation + string.punctuation
+PUNCTUATION_RE = re.compile(rf'[{PUNCTUATION}]')
+
+# Punctuation right after or before a word becomes a token of its own.
+PUNCT_AFTER_WORD_RE = re.compile(r"(\w+)([{}])".format(string.punctuation))
+PUNCT_BEFORE_WORD_RE = re.compile(r"([{}])(\w+)".format(string.punctuation))
+
+
+def clean_text(text: str) -> str:
+    text = text.replace('\n', ' ').strip()
+    text = PUNCT_AFTER_WORD_RE.sub(r'\1 \2', text)
+    text = PUNCT_BEFORE_WORD_RE.sub(r'\1 \2', text)
+    return text
+
+
+def tokenize(text: str) -> List[str]:
+    """The tokens of a text, as the concordance shows them and as stored in the index."""
+    return clean_text(text).split()
+
+
+def word_forms(text: str) -> Iterator[str]:
+    """The words counted in frequency lists: punctuation removed, and numbers and non-ASCII words left out."""
+    return filter(lambda x: x.isascii() and not x.isdigit(), PUNCTUATION_RE.sub(' ', text).split())
+
+
+def has_content(s: str) -> bool:
+    return bool(s) and not s.isspace() and s != 'NULL'
+
+
+def split_words(text: str) -> List[str]:
+    return list(filter(has_content, text.split()))
+
+
+def split_sentences(text: str) -> List[str]:
+    return list(filter(has_content, (t.strip() for t in SENT_BOUNDARY_RE.split(text))))
+
+
+class TextCounter:
+    """
+    Number of words and sentences of a text fed in chunks cut at whitespace (see TextFile.iter_text()).
+    Sentences can span chunks, so the text after the last boundary is carried over to the next one.
+    """
+    def __init__(self):
+        self.word_num = 0
+        self._sent_num = 0
+        self._rest = ''
+
+    def feed(self, chunk: str) -> None:
+        self.word_num += len(split_words(chunk))
+        sentences = SENT_BOUNDARY_RE.split(self._rest + chunk)
+        self._rest = sentences.pop()
+        self._sent_num += sum(1 for s in sentences if has_content(s.strip()))
+
+    @property
+    def sent_num(self) -> int:
+        return self._sent_num + has_content(self._rest.strip())
+
+
+def count_words_and_sentences(chunks: Iterable[str]) -> Tuple[int, int]:
+    counter = TextCounter()
+    for chunk in chunks:
+        counter.feed(chunk)
+    return counter.word_num, counter.sent_num
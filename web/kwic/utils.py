@@ -1,164 +1,98 @@
-from pathlib import Path
-import pickle
-import re
-import string
-from typing import Generator, Tuple, List, Set
+from typing import Callable, Dict, List, Tuple
 
-from django.db.models import Q
-from nltk.text import Text, ConcordanceLine, ConcordanceIndex
+import numpy as np
 
-from core.models import Headword, Example
-from freqdist.models import TextFile
+from . import index as corpus_index
+from .concordance import Concordance, context_keys, lower_ranks
+from .query import resolve_query, variant_map
 
-KWIC_PATH = Path(__file__).parent / 'static/kwic/kwic.pkl'
-if not KWIC_PATH.parent.exists():
-    KWIC_PATH.parent.mkdir(parents=True)
+DEFAULT_LINES = 500
+MAX_LINES = 5000  # bounds the work and the size of a result, however frequent the query
+MAX_WIDTH = 100  # tokens of context on either side
 
 
-def _get_texts(include_examples: bool) -> str:
-    files = TextFile.objects.all()
-    texts = " ".join(text.read_and_decode() for text in files)
-    if include_examples:
-        examples = " ".join(Example.objects.all().values_list('sentence', flat=True))
-        texts += " " + examples
-
-    return texts
-
-
-def _clean_texts(texts: str) -> str:
-    pat_one = r"(\w+)([{}])".format(string.punctuation)  # add space between char and punctuation
-    pat_two = r"([{}])(\w+)".format(string.punctuation)  # add space between punctuation and char
-
-    texts = re.sub('\n', ' ', texts).strip()
-    texts = re.sub(pat_one, r'\1 \2', texts)
-    texts = re.sub(pat_two, r'\1 \2', texts)
-    return texts
-
-
-def _build_conc_lines(t: List[str], ql: List[str], intersects: Set[int], width: int) -> List[ConcordanceLine]:
-    conc_lines = []
-    for offset in intersects:
-        left = t[max(offset - width, 0):offset]
-        center = t[offset:(offset + len(ql))]
-        right = t[(offset + len(ql)):(offset + len(ql) + width)]
-        left_print = " ".join(left)
-        right_print = " ".join(right)
-        center_print = " ".join(center)
-        line_print = " ".join([left_print, center_print, right_print])
-        conc_line = ConcordanceLine(
-            left=left,
-            query=center_print,
-            right=right,
-            offset=offset,
-            left_print=left_print,
-            right_print=right_print,
-            line=line_print
-        )
-        conc_lines.append(conc_line)
-
-    return conc_lines
-
-
-def _build_variant_dict() -> dict:
-    variant_dict = {}
-    for h in Headword.objects.filter(~Q(variant=[''])):
-        headword: str = h.headword
-        variant: list = h.variant
-        variant_dict[headword] = variant
-    return variant_dict
-
-
-def _add_headword_variants(words: Generator) -> list:
-    """Add variants of headwords within texts"""
-    new_words = []
-    variant_dict = _build_variant_dict()
-
-    for word in words:
-        vs = variant_dict.get(word)
-        if vs:
-            new_words.append(word)
-            for v in vs:
-                new_words.extend(['(', v, ')'])  # add parentheses as separate items so concordance will find them
-        else:
-            new_words.append(word)
-    return new_words
-
-
-def _get_normalized_offsets(c: ConcordanceIndex, qp: List[str]) -> List[List[int]]:
-    offsets_norm = []
-    offsets = [c.offsets(q) for q in qp]
-    for i in range(len(qp)):
-        offsets_norm.append([x - i for x in offsets[i]])
-
-    return offsets_norm
-
-
-def _sort_kwic(kwic: list, side: str = 'left', window: int = 2):
-    if side == 'left':
-        kwic.sort(key=lambda line: [w.lower() for w in line.left[-window:]])
-    else:
-        kwic.sort(key=lambda line: [w.lower() for w in line.right[:window]])
-    return kwic
-
-
-# def build_kwic(query: str, width: int, side: str = 'left', window: int = 2, include_examples=False) -> Tuple[list, int]:
-#     """
-#     Build a concordance.
-#     :param query: A word or phrase to be searched
-#     :param width: Set the number of characters on either side of the query
-#     :param side: Sort results either by the left or right context
-#     :param window: Sort the above selected side by the nth token starting from the query
-#     :param include_examples: Include dictionary examples
-#     :return: A concordance list and the total number of results returned
-#     """
-#     texts = _get_texts(include_examples)
-#     texts = _clean_texts(texts)
-#     word_gen = (word for word in texts.split())
-#     words = _add_headword_variants(word_gen)
-#     text = Text(words)
-#     conc_list = text.concordance_list(query, width=width, lines=9999999)  # show all lines
-#     conc_list = _sort_kwic(conc_list, side=side, window=window)
-#     conc_len = len(conc_list)
-#
-#     with KWIC_PATH.open('wb') as f:
-#         d = {
-#             'query': query,
-#             'conc_list': conc_list
-#         }
-#         pickle.dump(d, f)
-#     return conc_list, conc_len
-
-
-def build_kwic(query: str, width: int, side: str = 'left', window: int = 2, include_examples=False) -> Tuple[list, int]:
+def _count_hits(docs: List[corpus_index.IndexedDoc],
+                query_ids: List[np.ndarray]) -> Tuple[np.ndarray, Dict[int, np.ndarray]]:
+    """
+    Count the hits in each text. Single words and patterns are counted from the term statistics of the index
+    alone; for phrases only the texts that contain every word are scanned, and the offsets found are returned
+    by text.
     """
-    Build a concordance.
-    :param query: A word or phrase to be searched
-    :param width: Set the number of characters on either side of the query
-    :param side: Sort results either by the left or right context
-    :param window: Sort the above selected side by the nth token starting from the query
+    counts = np.zeros(len(docs), dtype=np.int64)
+    found = {}
+    if query_ids is None:  # some query word matches no token
+        return counts, found
+    for idx, doc in enumerate(docs):
+        stats = corpus_index.term_stats(doc)
+        word_counts = [int(stats.count(q).sum()) for q in query_ids]
+        if len(query_ids) == 1:
+            counts[idx] = word_counts[0]
+        elif min(word_counts):
+            found[idx] = corpus_index.find_offsets(doc.ids, query_ids)
+            counts[idx] = len(found[idx])
+    return counts, found
+
+
+def _select_hits(total: int, lines: int, sample: bool, seed: int) -> np.ndarray:
+    """Ordinals, in corpus order, of the hits to keep: the first ``lines``, or a random sample of them."""
+    if sample and total > lines:
+        # Generator.choice() draws without replacement without shuffling all ``total`` ordinals.
+        return np.sort(np.random.default_rng(seed).choice(total, lines, replace=False))
+    return np.arange(min(total, lines))
+
+
+def build_kwic(query: str, width: int, include_examples=False, lines: int = DEFAULT_LINES, sample=False,
+               seed: int = 0, progress: Callable[[float], None] = None) -> Concordance:
+    """
+    Build a concordance. Lines are sorted and rendered when shown, see :class:`kwic.concordance.Concordance`.
+    :param query: A word or phrase to be searched, whose words may be patterns, see :mod:`kwic.query`
+    :param width: Set the number of tokens on either side of the query
     :param include_examples: Include dictionary examples
-    :return: A concordance list and the total number of results returned
+    :param lines: Number of hits to keep, at most ``MAX_LINES``
+    :param sample: Keep a random sample of the hits instead of the first ones
+    :param seed: Seed of the random sample, so that the same sample can be drawn again
+    :param progress: Called with the fraction of texts searched so far
+    :return: The hits kept, and the number of hits in the corpus
     """
-    texts = _get_texts(include_examples)
-    texts = _clean_texts(texts)
-    word_gen = (word for word in texts.split())
-    words = _add_headword_variants(word_gen)
-
-    # Using this instead of Text.concordance_list() because it doesn't support multi-word searches.
-    # https://stackoverflow.com/a/34252075/7428193
-    ci = ConcordanceIndex(words)
     query_list = query.split()
-    offsets_norm = _get_normalized_offsets(ci, query_list)
-    # Finds the indexes that are common between all lists, i.e., the query
-    intersects = set(offsets_norm[0]).intersection(*offsets_norm[1:])
-    conc_list = _build_conc_lines(words, query_list, intersects,  width)
-    conc_list = _sort_kwic(conc_list, side=side, window=window)
-    conc_len = len(conc_list)
-
-    with KWIC_PATH.open('wb') as f:
-        d = {
-            'query': query,
-            'conc_list': conc_list
-        }
-        pickle.dump(d, f)
-    return conc_list, conc_len
+    # Offsets are looked up in the stored token ids instead of re-tokenizing the corpus on every request.
+    docs = corpus_index.load_docs(include_examples)
+    vocab = corpus_index.load_vocab()
+    # Spelling variants expand the query, so the texts are searched as they are.
+    query_ids = resolve_query(query_list, vocab, variant_map())
+    ranks = lower_ranks(vocab)
+
+    counts, found = _count_hits(docs, query_ids)
+    total = int(counts.sum())
+    selected = _select_hits(total, max(1, min(lines, MAX_LINES)), sample, seed)
+    # Only the texts holding selected hits are searched for their offsets.
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    lows, highs = np.searchsorted(selected, starts), np.searchsorted(selected, ends)
+    hits = []
+    for idx, doc in enumerate(docs):
+        if progress:
+            progress(idx / len(docs))
+        in_doc = selected[lows[idx]:highs[idx]] - starts[idx]
+        if not len(in_doc):
+            continue
+        offsets = found[idx] if idx in found else corpus_index.find_offsets(doc.ids, query_ids)
+        offsets = offsets[in_doc]
+        hits.append((np.full(len(offsets), idx, dtype=np.int32), offsets,
+                     *context_keys(doc.ids, offsets, len(query_list), width, ranks)))
+    if not hits:
+        no_hits = np.empty(0, dtype=np.int64)
+        hits.append((no_hits.astype(np.int32), no_hits,
+                     *context_keys(no_hits.astype(corpus_index.ID_DTYPE), no_hits, len(query_list), width, ranks)))
+    docs_of_hits, offsets, left_keys, right_keys = (np.concatenate(parts) for parts in zip(*hits))
+    return Concordance(
+        query_len=len(query_list),
+        width=width,
+        total=total,
+        doc_names=[doc.name for doc in docs],
+        doc_lengths=[len(doc.ids) for doc in docs],
+        docs=docs_of_hits,
+        offsets=offsets,
+        left_keys=left_keys,
+        right_keys=right_keys,
+    )
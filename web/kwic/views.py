@@ -1,59 +1,111 @@
 import csv
+import itertools
 from pathlib import Path
-import pickle
+import re
 
+from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
+from django.core.paginator import Paginator
+from django.http import StreamingHttpResponse
 from django.views.generic import View
-from django.shortcuts import render
+from django.shortcuts import render, redirect
 
-from .utils import build_kwic, KWIC_PATH
+from core.streaming import Echo
+from jobs.cache import results_cache
+from jobs.views import JobMixin, enqueue_and_redirect
+from .concordance import SIDES
+from .query import compile_word
+from .utils import DEFAULT_LINES, MAX_LINES, MAX_WIDTH
 
 
-class KwicView(LoginRequiredMixin, View):
+def _get_int(request, name: str, default: int, low: int = None, high: int = None) -> int:
+    """An integer form field, or ``default`` if it is blank or not a number, clamped to ``[low, high]``."""
+    try:
+        value = int(request.GET.get(name, default))
+    except ValueError:
+        value = default
+    if low is not None:
+        value = max(value, low)
+    if high is not None:
+        value = min(value, high)
+    return value
+
+
+def _get_sort(request):
+    """The side and window to sort the lines by. Sorting happens on display, so it is not a job parameter."""
+    side = request.GET.get('sort-side')
+    if side not in SIDES:
+        side = 'left'
+    return side, _get_int(request, 'sort-window', 2)
+
+
+class KwicView(LoginRequiredMixin, JobMixin, View):
     template_name = 'kwic/index.html'
+    job_kind = 'kwic'
+    paginate_by = 50
 
-    def get(self, request, *args, **kwargs):
-        query = request.GET.get('query')
-        width = int(request.GET.get('width', 80))
-        sort_side = request.GET.get('sort-side')
-        sort_window = int(request.GET.get('sort-window', 2))
-        include_examples = request.GET.get('include-examples')
-        if query:
-            conc_list, conc_len = build_kwic(query,
-                                             width=width,
-                                             side=sort_side,
-                                             window=sort_window,
-                                             include_examples=include_examples)
-            context = {
-                'conc_list': conc_list,
-                'conc_len': conc_len,
-            }
-            return render(request, self.template_name, context=context)
-        else:
-            return render(request, self.template_name)
+    def get_job_params(self):
+        query = self.request.GET.get('query')
+        if not query:
+            return None
+        try:
+            for word in query.split():
+                compile_word(word)
+        except re.error as e:
+            messages.error(self.request, f'Invalid regular expression: {e}')
+            return None
+        sample = bool(self.request.GET.get('sample'))
+        return {
+            'query': query,
+            'width': _get_int(self.request, 'width', 80, low=1, high=MAX_WIDTH),
+            'include_examples': bool(self.request.GET.get('include-examples')),
+            'lines': _get_int(self.request, 'lines', DEFAULT_LINES, low=1, high=MAX_LINES),
+            'sample': sample,
+            'seed': _get_int(self.request, 'seed', 0, low=0) if sample else 0,
+        }
+
+    def render_job_result(self, result):
+        context = {
+            'default_lines': DEFAULT_LINES,
+            'max_lines': MAX_LINES,
+        }
+        if result is None:
+            return render(self.request, self.template_name, context=context)
+        if not result.is_current():  # texts indexed again since, so the stored offsets are off
+            return enqueue_and_redirect(self.request, self.job_kind, self.get_job_params())
+        # Only the lines of the page shown are rendered.
+        side, window = _get_sort(self.request)
+        lines = result.sorted(side, window)
+        page_obj = Paginator(lines, self.paginate_by).get_page(self.request.GET.get('page'))
+        context.update({
+            'page_obj': page_obj,
+            'is_paginated': page_obj.has_other_pages(),
+            'sort_side': side,
+            'sort_window': window,
+            'include_examples': bool(self.request.GET.get('include-examples')),
+            'conc_len': len(result),
+            'conc_total': result.total,
+            'result_key': self.result_key,
+        })
+        return render(self.request, self.template_name, context=context)
 
 
 @login_required
 def export_results_to_csv(request):
-    with KWIC_PATH.open('rb') as f:
-        d = pickle.load(f)
-    conc_list = d.get('conc_list')
-    query = d.get('query')
+    result = results_cache.get(request.GET.get('result_key', ''))
+    if result is None or not result.is_current():
+        messages.error(request, 'These results have expired. Please search again.')
+        return redirect('kwic:index')
+    query = request.GET.get('query')
     filename = Path(f"KWIC_{query}.csv")
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = f'attachment; filename="{filename}"'
 
     header = ['left', 'query', 'right']
 
-    kwic_writer = csv.writer(response)
-    kwic_writer.writerow(header)
-
-    for row in conc_list:
-        kwic_writer.writerow([
-            row.left_print,
-            query,
-            row.right_print
-        ])
+    kwic_writer = csv.writer(Echo())
+    # The query column holds the tokens matched, which differ from the query for patterns.
+    rows = ([row.left_print, row.query, row.right_print] for row in result.sorted(*_get_sort(request)))
+    response = StreamingHttpResponse((kwic_writer.writerow(row) for row in itertools.chain([header], rows)),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
     return response
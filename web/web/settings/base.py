@@ -44,6 +44,7 @@ INSTALLED_APPS = [
     'freqdist',
     'kwic',
     'collocations',
+    'jobs',
     'django_extensions',
     'crispy_forms',
     'extra_views',
@@ -194,8 +195,13 @@ REST_FRAMEWORK = {
 
 CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
+# Cached corpus analyses (jobs.cache.ResultCache)
+RESULTS_CACHE_DIR = os.path.join(BASE_DIR, 'data/results/')  # private: outside STATIC_ROOT and MEDIA_ROOT
+RESULTS_CACHE_MAX_ENTRIES = 200
+RESULTS_CACHE_TTL = 7 * 24 * 60 * 60  # seconds
+
 SESSION_ENGINE = "django.contrib.sessions.backends.file"
-SESSION_SERIALIZER = 'django.contrib.sessions.serializers.PickleSerializer'
+SESSION_SERIALIZER = 'django.contrib.sessions.serializers.JSONSerializer'
 
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
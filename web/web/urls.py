@@ -24,6 +24,7 @@ urlpatterns = [
     path('freq/', include('freqdist.urls', namespace='freq')),
     path('kwic/', include('kwic.urls', namespace='kwic')),
     path('collocation/', include('collocations.urls', namespace='collocations')),
+    path('jobs/', include('jobs.urls', namespace='jobs')),
     path('', include('core.urls', namespace='core')),
     path('accounts/', include('django.contrib.auth.urls'))
               ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)